@@ -0,0 +1,244 @@
+# In this file, a checksum manifest of the ingested files is written while they are renamed or moved,
+# so the ingest can be verified later without a second pass with external tools.
+
+# The manifest is a listener of the file operations in FileUtility, like the library index:
+# - the files copied across devices are hashed while their bytes are streamed (see copyFileStreaming),
+# - the files renamed or moved on the same device are hashed in parallel through mmap, by a thread pool.
+#   Until a file is hashed, its record follows the later renames of the file (e.g. -m and then -p), and it is dropped if the file is deleted.
+# Each line of the manifest is: algorithm:hash <TAB> size <TAB> new name <TAB> original name
+# The new names are relative to the folder of the manifest file, so the tree can be verified wherever it is mounted.
+# When a recorded file is renamed again (a re-run, a restore, a merge) or deleted, a removal line is appended:
+# removed <TAB> 0 <TAB> old name <TAB> original name, and the later lines of the manifest win.
+
+import os
+import os.path
+import mmap
+import hashlib
+import threading
+import concurrent.futures
+import logging
+
+from FileUtility import *
+
+logger = logging.getLogger(__name__)
+
+checksumAlgorithmList = ["blake2b", "sha256"]
+# the checksum field of the removal lines
+removedChecksum = "removed"
+
+def hashFile(filePath, algorithm = "blake2b"):
+    '''Hash the file through mmap, the chunks are hashed without holding the GIL, so several files can be hashed in parallel.
+    Return the hex digest and the size of the file.'''
+    hasher = hashlib.new(algorithm)
+    with open(filePath, "rb") as file:
+        fileSize = os.fstat(file.fileno()).st_size
+        # an empty file can not be mapped
+        if fileSize > 0:
+            with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as mappedFile:
+                with memoryview(mappedFile) as view:
+                    for offset in range(0, fileSize, copyChunkSize):
+                        hasher.update(view[offset:offset + copyChunkSize])
+    return hasher.hexdigest(), fileSize
+
+def formatManifestLine(algorithm, digest, fileSize, relativePath, originalFilename):
+    return algorithm + ":" + digest + "\t" + str(fileSize) + "\t" + relativePath + "\t" + originalFilename + "\n"
+
+def parseManifestLine(line):
+    '''Parse a line of the manifest. Return (algorithm, digest, size, relative path, original name), or None for the comments.
+    The algorithm and the digest are None for the removal lines.'''
+    line = line.rstrip("\n")
+    if not line or line.startswith("#"):
+        return None
+    checksum, fileSize, relativePath, originalFilename = line.split("\t")
+    if checksum == removedChecksum:
+        return None, None, int(fileSize), relativePath, originalFilename
+    algorithm, digest = checksum.split(":", 1)
+    return algorithm, digest, int(fileSize), relativePath, originalFilename
+
+class PendingHash:
+    '''A file waiting in the thread pool to be hashed, its path follows the renames of the file until it is written'''
+    def __init__(self, filePath, originalFilename):
+        self.filePath = filePath
+        self.originalFilename = originalFilename
+        # the file is deleted or uploaded before it is hashed
+        self.isCancelled = False
+
+class ChecksumManifest:
+    '''The streaming checksum manifest of the renamed and moved files'''
+    def __init__(self, manifestPath, algorithm = "blake2b", maxWorkers = 8):
+        if algorithm not in checksumAlgorithmList:
+            raise ValueError("Unsupported checksum algorithm: " + algorithm)
+        self.manifestPath = os.path.abspath(manifestPath)
+        self.rootFolder = os.path.dirname(self.manifestPath)
+        self.algorithm = algorithm
+        os.makedirs(self.rootFolder, exist_ok = True)
+        # the relative paths recorded so far -> their original names, the files renamed or deleted from them get a removal line
+        self.recordedOriginalFilenameDict = {}
+        if os.path.isfile(self.manifestPath):
+            for relativePath, (algorithm, digest, fileSize, originalFilename) in readManifest(self.manifestPath).items():
+                self.recordedOriginalFilenameDict[relativePath] = originalFilename
+        # the manifest is appended, so several runs can write into the same manifest
+        self.manifestFile = open(self.manifestPath, "a", encoding = "utf-8")
+        if self.manifestFile.tell() == 0:
+            self.manifestFile.write("# algorithm:hash\tsize\tnew name\toriginal name\n")
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers)
+        # the hashers of the files being copied across devices, keyed by the new file path
+        self.copyHasherDict = {}
+        # the PendingHash of the files not hashed yet, keyed by their current file path
+        self.pendingHashDict = {}
+        self.writtenCount = 0
+        self.errorCount = 0
+
+    def close(self):
+        '''Wait for the files still being hashed, and close the manifest file'''
+        self.executor.shutdown(wait = True)
+        with self.lock:
+            self.manifestFile.close()
+
+    def __enter__(self):
+        addFileOperationListener(self)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        removeFileOperationListener(self)
+        self.close()
+
+    def createCopyHasher(self, newFilePath):
+        '''Get the hasher of the bytes of the file copied to newFilePath, see copyFileStreaming'''
+        hasher = hashlib.new(self.algorithm)
+        with self.lock:
+            self.copyHasherDict[os.path.abspath(newFilePath)] = hasher
+        return hasher
+
+    def writeLine(self, digest, fileSize, newFilePath, originalFilename):
+        '''Write the line of the file to the manifest. The caller holds the lock.'''
+        relativePath = os.path.relpath(newFilePath, self.rootFolder)
+        self.manifestFile.write(formatManifestLine(self.algorithm, digest, fileSize, relativePath, originalFilename))
+        self.recordedOriginalFilenameDict[relativePath] = originalFilename
+        self.writtenCount = self.writtenCount + 1
+
+    def removeRecordedFile(self, filePath):
+        '''Append a removal line if the file is recorded in the manifest. Return its recorded original name, None if it is not recorded.'''
+        relativePath = os.path.relpath(os.path.abspath(filePath), self.rootFolder)
+        with self.lock:
+            originalFilename = self.recordedOriginalFilenameDict.pop(relativePath, None)
+            if originalFilename is not None:
+                self.manifestFile.write(removedChecksum + "\t0\t" + relativePath + "\t" + originalFilename + "\n")
+        return originalFilename
+
+    def hashAndWrite(self, pendingHash):
+        '''Hash the file of the PendingHash at its current path, and write its line.
+        If the file is renamed while it is being opened, it is hashed again at its new path.'''
+        while True:
+            with self.lock:
+                if pendingHash.isCancelled:
+                    return
+                filePath = pendingHash.filePath
+            try:
+                digest, fileSize = hashFile(filePath, self.algorithm)
+            except OSError as e:
+                with self.lock:
+                    if pendingHash.isCancelled:
+                        return
+                    if pendingHash.filePath != filePath:
+                        continue
+                    del self.pendingHashDict[filePath]
+                    self.errorCount = self.errorCount + 1
+                logger.warning("Error: can not hash " + filePath + ": " + str(e))
+                return
+            with self.lock:
+                if pendingHash.isCancelled:
+                    return
+                # the file might be renamed while it is hashed, its line is written with its current path
+                del self.pendingHashDict[pendingHash.filePath]
+                self.writeLine(digest, fileSize, pendingHash.filePath, pendingHash.originalFilename)
+            return
+
+    def cancelPendingHash(self, filePath):
+        '''Drop the PendingHash of the file if it is not hashed yet. Return the PendingHash, None if there is none.'''
+        with self.lock:
+            pendingHash = self.pendingHashDict.pop(filePath, None)
+            if pendingHash is not None:
+                pendingHash.isCancelled = True
+            return pendingHash
+
+    def onFileRenamed(self, oldFilePath, newFilePath):
+        oldFilePath = os.path.abspath(oldFilePath)
+        isUploaded = "://" in newFilePath
+        if not isUploaded:
+            newFilePath = os.path.abspath(newFilePath)
+            with self.lock:
+                pendingHash = self.pendingHashDict.pop(oldFilePath, None)
+                if pendingHash is not None:
+                    # the file is not hashed yet, it is hashed at its new name
+                    pendingHash.filePath = newFilePath
+                    self.pendingHashDict[newFilePath] = pendingHash
+                    return
+        elif self.cancelPendingHash(oldFilePath) is not None:
+            logger.debug("The file " + oldFilePath + " is uploaded before it is hashed.")
+        # a recorded file keeps its original name through the later renames
+        originalFilename = self.removeRecordedFile(oldFilePath)
+        if isUploaded:
+            # the objects uploaded to a remote destination (see DestinationBackend) can not be verified from the local tree
+            logger.debug("The uploaded object " + newFilePath + " is not recorded in the manifest.")
+            return
+        if originalFilename is None:
+            originalFilename = os.path.basename(oldFilePath)
+        with self.lock:
+            hasher = self.copyHasherDict.pop(newFilePath, None)
+            if hasher is not None:
+                # the bytes are already hashed while they were copied
+                self.writeLine(hasher.hexdigest(), os.stat(newFilePath).st_size, newFilePath, originalFilename)
+                return
+            pendingHash = self.pendingHashDict[newFilePath] = PendingHash(newFilePath, originalFilename)
+        self.executor.submit(self.hashAndWrite, pendingHash)
+
+    def onFileDeleted(self, filePath):
+        filePath = os.path.abspath(filePath)
+        if self.cancelPendingHash(filePath) is None:
+            self.removeRecordedFile(filePath)
+
+def readManifest(manifestPath):
+    '''Read the manifest. Return a dict of relative path -> (algorithm, digest, size, original name), the last line of a path wins,
+    and the paths of the removal lines are dropped.'''
+    manifestDict = {}
+    with open(manifestPath, "r", encoding = "utf-8") as manifestFile:
+        for line in manifestFile:
+            manifestLine = parseManifestLine(line)
+            if manifestLine is not None:
+                algorithm, digest, fileSize, relativePath, originalFilename = manifestLine
+                if algorithm is None:
+                    manifestDict.pop(relativePath, None)
+                else:
+                    manifestDict[relativePath] = (algorithm, digest, fileSize, originalFilename)
+    return manifestDict
+
+def verifyManifest(manifestPath, maxWorkers = 8):
+    '''Recheck the files of the manifest in parallel.
+    Return the number of the files checked, and the list of (relative path, reason) which do not match.'''
+    rootFolder = os.path.dirname(os.path.abspath(manifestPath))
+    manifestDict = readManifest(manifestPath)
+
+    def verify(relativePath):
+        algorithm, digest, fileSize, originalFilename = manifestDict[relativePath]
+        filePath = os.path.join(rootFolder, relativePath)
+        try:
+            # check the size first, it does not need to read the file
+            if os.stat(filePath).st_size != fileSize:
+                return "size mismatch"
+            if hashFile(filePath, algorithm)[0] != digest:
+                return "checksum mismatch"
+        except FileNotFoundError:
+            return "missing"
+        except OSError as e:
+            return str(e)
+        return None
+
+    failedList = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+        for relativePath, reason in zip(manifestDict, executor.map(verify, manifestDict)):
+            if reason is not None:
+                logger.warning(relativePath + ": " + reason)
+                failedList.append((relativePath, reason))
+    return len(manifestDict), failedList
@@ -0,0 +1,125 @@
+# In this file, the destinations of the renamed and moved files are abstracted as backends,
+# so the files can be ingested straight into an object storage instead of a mounted folder.
+
+# A backend lists the names in a sub folder of the destination (for the DestinationFolderIndex),
+# checks if a name is already the same file, and moves a file to its new name (see FileUtility.renameFile):
+# - LocalDestinationBackend (in FileUtility): the destination folder on the file system, the default,
+# - S3DestinationBackend: a bucket of Amazon S3 or a compatible server (MinIO, Ceph, ...), through boto3.
+#   The keys are the prefix and the formatted names (with the sub folders of the layout),
+#   the large files (e.g. GoPro videos) are uploaded in parallel multipart uploads over a pool of connections.
+# boto3 is only needed for the S3 destination: pip install boto3
+
+import os
+import os.path
+import urllib.parse
+import logging
+
+from FileUtility import *
+
+try:
+    import boto3
+    import botocore.config
+    import botocore.exceptions
+    from boto3.s3.transfer import TransferConfig
+    isBoto3Installed = True
+except ImportError:
+    isBoto3Installed = False
+
+logger = logging.getLogger(__name__)
+
+# the metadata of the uploaded objects, the modification time is kept as it is used to name the files
+modifiedTimeMetadataKey = "mtime-ns"
+originalNameMetadataKey = "original-name"
+
+class S3DestinationBackend:
+    '''The destination prefix in a bucket of S3 or a compatible server.
+    endpointUrl is the URL of a compatible server, e.g. http://localhost:9000 for a local MinIO, None for AWS.
+    The files larger than multipartThreshold are uploaded in parts of multipartChunkSize, maxConcurrency parts at once,
+    by up to maxWorkers files at once (the parallel operations of the pipeline, see MediaProcessConfig).
+    The source files are deleted after they are uploaded, unless isKeepSource.'''
+    isLocal = False
+
+    def __init__(self, bucket, prefix = "", endpointUrl = None, maxWorkers = 8, multipartThreshold = 64 * 1024 * 1024,
+                 multipartChunkSize = 16 * 1024 * 1024, maxConcurrency = 8, isKeepSource = False):
+        if not isBoto3Installed:
+            raise RuntimeError("boto3 is needed for the S3 destination: pip install boto3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.isKeepSource = isKeepSource
+        # the client is thread safe, and its connections are pooled and reused by the workers of the execute stage.
+        # Every worker can upload maxConcurrency parts at once, the pool holds all of them, so no connection is discarded.
+        clientConfig = botocore.config.Config(max_pool_connections = maxWorkers * maxConcurrency, retries = {"mode": "adaptive"})
+        self.client = boto3.client("s3", endpoint_url = endpointUrl, config = clientConfig)
+        self.transferConfig = TransferConfig(multipart_threshold = multipartThreshold, multipart_chunksize = multipartChunkSize,
+                                             max_concurrency = maxConcurrency, use_threads = True)
+
+    def getKey(self, relativePath):
+        '''Get the key of the object, the sub folders of the layout are joined with "/"'''
+        key = "/".join(relativePath.split(os.sep))
+        return key if not self.prefix else self.prefix + "/" + key
+
+    def getLocation(self, relativePath):
+        return "s3://" + self.bucket + "/" + self.getKey(relativePath)
+
+    def listFolder(self, subFolder):
+        '''Get the set of the object names directly under the sub folder of the prefix'''
+        folderKey = self.getKey(subFolder) if subFolder else self.prefix
+        folderKey = folderKey + "/" if folderKey else ""
+        filenameSet = set()
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket = self.bucket, Prefix = folderKey, Delimiter = "/"):
+            for content in page.get("Contents", []):
+                filenameSet.add(content["Key"][len(folderKey):])
+        return filenameSet
+
+    def isFile(self, relativePath, destinationFolderFd = None):
+        '''check if the object exists'''
+        try:
+            self.client.head_object(Bucket = self.bucket, Key = self.getKey(relativePath))
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def isSameFile(self, filePath, relativePath, destinationFolderFd = None):
+        '''check if the object is already the upload of the file, by its size and modification time.
+        Return False if the object or the file does not exist.'''
+        try:
+            fileStat = os.stat(filePath)
+            response = self.client.head_object(Bucket = self.bucket, Key = self.getKey(relativePath))
+        except Exception:
+            return False
+        return response["ContentLength"] == fileStat.st_size and \
+            response.get("Metadata", {}).get(modifiedTimeMetadataKey) == str(fileStat.st_mtime_ns)
+
+    def moveFile(self, sourceFolderPath, filename, relativePath, sourceFolderFd = None, destinationFolderFd = None, listenerList = None):
+        '''Upload the file to the key of the relative path, and delete the source file. Return the s3:// URL of the object.'''
+        filePath = os.path.join(sourceFolderPath, filename)
+        metadata = {modifiedTimeMetadataKey: str(os.stat(filePath).st_mtime_ns),
+                    # the metadata must be ASCII
+                    originalNameMetadataKey: urllib.parse.quote(filename)}
+        try:
+            self.client.upload_file(filePath, self.bucket, self.getKey(relativePath), ExtraArgs = {"Metadata": metadata},
+                                    Config = self.transferConfig)
+        except (botocore.exceptions.ConnectionError, botocore.exceptions.ReadTimeoutError) as e:
+            # the server is not answering in time, the concurrency is adapted to it (see isCongestionError)
+            raise TimeoutError(str(e)) from e
+        if not self.isKeepSource:
+            os.unlink(getPathInFolder(sourceFolderPath, filename, sourceFolderFd), dir_fd = sourceFolderFd)
+        return self.getLocation(relativePath)
+
+def isS3Url(url):
+    return url is not None and url.startswith("s3://")
+
+def parseS3Url(url):
+    '''Parse s3://bucket/prefix. Return (bucket, prefix).'''
+    parsedUrl = urllib.parse.urlparse(url)
+    if parsedUrl.scheme != "s3" or not parsedUrl.netloc:
+        raise ValueError("Invalid S3 URL: " + url)
+    return parsedUrl.netloc, parsedUrl.path.strip("/")
+
+def createS3DestinationBackend(url, endpointUrl = None, **kwargs):
+    '''Create the S3 destination of s3://bucket/prefix'''
+    bucket, prefix = parseS3Url(url)
+    return S3DestinationBackend(bucket, prefix, endpointUrl, **kwargs)
@@ -0,0 +1,292 @@
+# In this file, the rename plan of huge folders (tens of millions of files) is made with a bounded memory.
+
+# os.listdir returns the files in an arbitrary order, so the unique IDs (_NN) given to the files
+# with the same formatted name depend on that order. Here, the files are planned in the captured order instead:
+#   1. Every file is read once, as a record of (captured date and time, camera ID, path, formatted name fields).
+#      The records are sorted in runs which fit in the memory limit, and each run is spilled to a temporary file.
+#   2. The runs are merged (k-way), so the records come back in the captured order,
+#      and the unique IDs are given in that order, which is the same for every run of the planner.
+#   3. The RenameOperations are yielded one by one, and can be streamed to MediaPipeline.execute().
+# Nothing else grows with the number of the files: the names can only collide within the files of the same
+# captured date and time and camera ID, which come one after another, so only the names reserved for that group
+# are held in the memory (see CapturedGroupFolderIndex), and the existing names and the sidecar files are checked on the disk.
+
+import os
+import os.path
+import sys
+import time
+import heapq
+import pickle
+import tempfile
+import logging
+
+from FileUtility import *
+from ProgressReporter import getCountedSkipFunction
+
+logger = logging.getLogger(__name__)
+
+# the runs are merged at most this many at once, so the number of the opened files is limited
+maximumMergedRunCount = 64
+# the files of a folder are sniffed in parallel by batches of this many, so the names of a huge folder are not held at once
+sniffBatchSize = 1024
+
+class CapturedGroupFolderIndex(DestinationFolderIndex):
+    '''The filename index of the destination folder for the files coming in the captured order.
+    Only the names reserved for the current group (captured date and time, camera ID) are held in the memory,
+    the names already in the destination folder are checked on the disk (or through the destination backend).'''
+    def __init__(self, destinationFolderPath, destinationBackend = None):
+        super().__init__(destinationFolderPath, destinationBackend)
+        self.groupKey = None
+        # the sub folders already created, there is one per date at most
+        self.subFolderSet = set()
+
+    def startGroup(self, groupKey):
+        '''Forget the names reserved for the previous group, they can not collide with the names of a new group'''
+        with self.lock:
+            if groupKey != self.groupKey:
+                self.groupKey = groupKey
+                self.filenameSetDict = {}
+
+    def getFilenameSet(self, subFolder):
+        '''Get the names reserved in the sub folder for the current group. Create the sub folder if it is the first time.'''
+        if subFolder not in self.subFolderSet:
+            if self.destinationBackend.isLocal:
+                os.makedirs(os.path.join(self.destinationFolderPath, subFolder), exist_ok = True)
+            self.subFolderSet.add(subFolder)
+        return self.filenameSetDict.setdefault(subFolder, set())
+
+    def isFileInDestination(self, subFolder, filename):
+        return self.destinationBackend.isFile(os.path.join(subFolder, filename))
+
+    def isFilenameTaken(self, subFolder, filename):
+        with self.lock:
+            if filename in self.getFilenameSet(subFolder):
+                return True
+        return self.isFileInDestination(subFolder, filename)
+
+    def reserveFilename(self, subFolder, filename):
+        '''Take the filename in the sub folder. Return False if it is already taken, in the current group or on the disk.'''
+        if self.isFileInDestination(subFolder, filename):
+            return False
+        with self.lock:
+            filenameSet = self.getFilenameSet(subFolder)
+            if filename in filenameSet:
+                return False
+            filenameSet.add(filename)
+            return True
+
+def getRecordSize(record):
+    '''Estimate the memory used by a record'''
+    return sys.getsizeof(record) + sum(sys.getsizeof(field) for field in record)
+
+def writeRun(recordList, temporaryFolder):
+    '''Sort the records and write them to a new temporary file. Return the file path.'''
+    recordList.sort()
+    fd, runFilePath = tempfile.mkstemp(prefix = "run-", suffix = ".pickle", dir = temporaryFolder)
+    with os.fdopen(fd, "wb") as runFile:
+        for record in recordList:
+            pickle.dump(record, runFile, pickle.HIGHEST_PROTOCOL)
+    return runFilePath
+
+def readRun(runFilePath):
+    '''Yield the records of a run file in their sorted order'''
+    with open(runFilePath, "rb") as runFile:
+        while True:
+            try:
+                yield pickle.load(runFile)
+            except EOFError:
+                return
+
+def mergeRuns(runFilePathList, temporaryFolder):
+    '''Merge the runs into one run file, and delete them. Return the path of the merged run file.'''
+    fd, runFilePath = tempfile.mkstemp(prefix = "run-", suffix = ".pickle", dir = temporaryFolder)
+    with os.fdopen(fd, "wb") as runFile:
+        for record in heapq.merge(*[readRun(path) for path in runFilePathList]):
+            pickle.dump(record, runFile, pickle.HIGHEST_PROTOCOL)
+    for path in runFilePathList:
+        os.remove(path)
+    return runFilePath
+
+class ExternalMemoryPlanner:
+    '''Plan the renaming of the media files in the captured order, with the records spilled to sorted runs on the disk.
+    memoryLimit is the approximate number of bytes of the records held in the memory at once.
+    The files are sniffed while their folder is listed if isSniffContent, and the trash files are deleted then if isDeleteTrashFiles
+    (the sidecar files are kept if isKeepSidecarFiles), the listeners of listenerList are notified of the deletions.'''
+    def __init__(self, destinationFolder = None, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False,
+                 layout = DestinationLayout.Flat, memoryLimit = 64 * 1024 * 1024, temporaryFolder = None, progressReporter = None,
+                 timeOffsetTable = None, isSniffContent = False, isDeleteTrashFiles = False, isKeepSidecarFiles = False, maxWorkers = 8,
+                 listenerList = None):
+        # if the destination folder is None, the files are renamed in their source folder
+        self.destinationFolder = destinationFolder
+        self.overrideCameraID = overrideCameraID
+        self.defaultCameraID = defaultCameraID
+        self.isUseModifiedTime = isUseModifiedTime
+        self.layout = layout
+        self.memoryLimit = memoryLimit
+        # the ProgressReporter of the plan stage, None to count nothing
+        self.progressReporter = progressReporter
+        # the time shift folded into the plan (see TimeOffsetTable), None to keep the times
+        self.timeOffsetTable = timeOffsetTable
+        self.isSniffContent = isSniffContent
+        self.isDeleteTrashFiles = isDeleteTrashFiles
+        self.isKeepSidecarFiles = isKeepSidecarFiles
+        # the number of the files sniffed in parallel
+        self.maxWorkers = maxWorkers
+        self.listenerList = listenerList
+        self.temporaryDirectory = tempfile.TemporaryDirectory(prefix = "media-plan-", dir = temporaryFolder)
+        self.recordList = []
+        self.recordListSize = 0
+        self.runFilePathList = []
+        # the extensions of the sidecar files seen in each folder, the sidecar files themselves are found on the disk when they are planned
+        self.sidecarExtensionSetDict = {}
+
+    def close(self):
+        '''Delete the run files'''
+        self.temporaryDirectory.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def addFolder(self, folderPath, sniffResultDict = None):
+        '''Read the files in the folder into the sorted runs. Return the number of the media files added.
+        sniffResultDict is the sniffed content of the files (see deleteTrashFiles), used to tell videos from images.
+        If it is not given, the files are sniffed by batches while the folder is listed (see isSniffContent),
+        and the trash files are deleted in the same pass (see isDeleteTrashFiles).'''
+        addedCount = 0
+        skipFunction = getFormattedInPlaceSkipFunction(folderPath, self.destinationFolder, self.overrideCameraID, self.isUseModifiedTime,
+                                                       self.layout, sniffResultDict, self.timeOffsetTable)
+        skipFunction = getCountedSkipFunction(skipFunction, self.progressReporter)
+        trashFunction = None
+        if self.isDeleteTrashFiles:
+            trashFunction = getTrashFunction(folderPath, self.isKeepSidecarFiles, listenerList = self.listenerList)
+        isSniffed = sniffResultDict is None and (self.isSniffContent or self.isDeleteTrashFiles)
+        filenameBatch = []
+        with os.scandir(folderPath) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if trashFunction is not None and trashFunction(entry):
+                    continue
+                if isSidecarFile(entry.name):
+                    # the sidecar file is paired with its primary file when the plan is merged
+                    self.sidecarExtensionSetDict.setdefault(folderPath, set()).add(os.path.splitext(entry.name)[1])
+                    continue
+                if skipFunction is not None and skipFunction(entry):
+                    continue
+                if isSniffed:
+                    filenameBatch.append(entry.name)
+                    if len(filenameBatch) >= sniffBatchSize:
+                        addedCount = addedCount + self.addSniffedFiles(folderPath, filenameBatch)
+                        filenameBatch = []
+                elif self.addFile(entry.path, getFileType(entry.path, sniffResultDict)):
+                    addedCount = addedCount + 1
+        addedCount = addedCount + self.addSniffedFiles(folderPath, filenameBatch)
+        if self.progressReporter is not None:
+            self.progressReporter.addTotal("plan", addedCount)
+        return addedCount
+
+    def addSniffedFiles(self, folderPath, filenameList):
+        '''Sniff a batch of the files in the folder in parallel, delete the empty and corrupted ones if isDeleteTrashFiles,
+        and add the others. The sniffed content is only used for the file types, it is not kept. Return the number of the files added.'''
+        if not filenameList:
+            return 0
+        sniffResultDict = sniffFilesInFolder(folderPath, [filename for filename in filenameList if isVideoOrImageFile(filename)], self.maxWorkers)
+        deletedFilePathSet = set()
+        if self.isDeleteTrashFiles:
+            deletedFilePathSet = deleteCorruptedSniffedFiles(folderPath, sniffResultDict, listenerList = self.listenerList)
+        addedCount = 0
+        for filename in filenameList:
+            filePath = os.path.join(folderPath, filename)
+            if filePath not in deletedFilePathSet and self.addFile(filePath, getFileType(filePath, sniffResultDict)):
+                addedCount = addedCount + 1
+        return addedCount
+
+    def addFile(self, filePath, fileType = None):
+        '''Add the media file to the current run. Return False if it is not a video or image file.'''
+        timeOffsetInNanoseconds = 0
+        if self.timeOffsetTable is not None:
+            timeOffsetInNanoseconds = self.timeOffsetTable.getFileOffset(filePath, self.overrideCameraID, self.defaultCameraID)
+        try:
+            formattedNameFields = getFormattedNameFieldsV4(filePath, self.overrideCameraID, self.defaultCameraID, self.isUseModifiedTime,
+                                                           self.layout, fileType, timeOffsetInNanoseconds)
+        except Exception as e:
+            logger.debug("Error: " + str(e))
+            return False
+        if formattedNameFields is None:
+            return False
+        capturedDate, capturedTime, cameraID, originalFilenameWithoutExtension, fileExtension, subFolder = formattedNameFields
+        sourceFolder, filename = os.path.split(filePath)
+        # the records are sorted by the captured date and time, the camera ID and the path
+        record = (capturedDate + "_" + capturedTime, cameraID, sourceFolder, filename, capturedDate, capturedTime,
+                  originalFilenameWithoutExtension, fileExtension, subFolder, timeOffsetInNanoseconds)
+        self.recordList.append(record)
+        self.recordListSize = self.recordListSize + getRecordSize(record)
+        if self.recordListSize >= self.memoryLimit:
+            self.spill()
+        return True
+
+    def spill(self):
+        '''Write the records in the memory as a sorted run'''
+        if not self.recordList:
+            return
+        self.runFilePathList.append(writeRun(self.recordList, self.temporaryDirectory.name))
+        logger.debug("Spilled " + str(len(self.recordList)) + " records to the run " + self.runFilePathList[-1] + ".")
+        self.recordList = []
+        self.recordListSize = 0
+        if len(self.runFilePathList) >= maximumMergedRunCount:
+            # merge the runs so far into one, to keep the number of the opened files limited in the final merge
+            self.runFilePathList = [mergeRuns(self.runFilePathList, self.temporaryDirectory.name)]
+
+    def getRecords(self):
+        '''Yield all the records in the captured order, merging the runs on the disk and the records in the memory'''
+        self.recordList.sort()
+        runList = [readRun(path) for path in self.runFilePathList]
+        runList.append(iter(self.recordList))
+        return heapq.merge(*runList)
+
+    def getSidecarFilenameList(self, folderPath, primaryFilename):
+        '''Find the sidecar files of the primary file on the disk, with the sidecar extensions seen in the folder'''
+        sidecarFilenameList = []
+        for fileExtension in self.sidecarExtensionSetDict.get(folderPath, ()):
+            for sidecarStem in getSidecarStemList(os.path.splitext(primaryFilename)[0]):
+                sidecarFilename = sidecarStem + fileExtension
+                # the same file might be found with another case of the extension on a case-insensitive file system
+                if sidecarFilename.upper() not in (filename.upper() for filename in sidecarFilenameList) \
+                        and isFileInFolder(folderPath, sidecarFilename):
+                    sidecarFilenameList.append(sidecarFilename)
+        return sidecarFilenameList
+
+    def getRenameOperations(self, destinationBackend = None):
+        '''Yield the RenameOperations in the captured order. The unique IDs are given in that order.
+        The name collisions are checked in a CapturedGroupFolderIndex for each destination folder,
+        through destinationBackend for the destination folder if it is given.'''
+        destinationFolderIndexDict = {}
+        for record in self.getRecords():
+            capturedAt, cameraID, sourceFolder, filename, capturedDate, capturedTime, originalFilenameWithoutExtension, fileExtension, subFolder, \
+                timeOffsetInNanoseconds = record
+            filePath = os.path.join(sourceFolder, filename)
+            destinationFolder = sourceFolder if self.destinationFolder is None else self.destinationFolder
+            index = destinationFolderIndexDict.get(destinationFolder)
+            if index is None:
+                backend = destinationBackend if destinationFolder == self.destinationFolder else None
+                if backend is None or backend.isLocal:
+                    os.makedirs(destinationFolder, exist_ok = True)
+                index = destinationFolderIndexDict[destinationFolder] = CapturedGroupFolderIndex(destinationFolder, backend)
+            index.startGroup((capturedAt, cameraID))
+            sidecarFilenameList = self.getSidecarFilenameList(sourceFolder, filename)
+            formattedNameFields = (capturedDate, capturedTime, cameraID, originalFilenameWithoutExtension, fileExtension, subFolder)
+            planStartTime = time.monotonic()
+            newFilename = None
+            try:
+                newFilename = reserveFormattedNameV4(filePath, formattedNameFields, destinationFolder, None, index)
+            except Exception as e:
+                logger.debug("Error: " + str(e))
+            if self.progressReporter is not None:
+                self.progressReporter.addPlanned(newFilename, time.monotonic() - planStartTime)
+            if newFilename is None:
+                logger.debug("The file " + filePath + " is not renamed or moved.")
+                continue
+            yield createRenameOperation(filePath, destinationFolder, newFilename, index, sidecarFilenameList, timeOffsetInNanoseconds)
@@ -18,8 +18,6 @@
 # YYYYMMDD_HHMMSSTT_IIIII_NN_OriginalFilename.*
 # Date_Time_CameraAndDataType_CameraID_UniqueID_OriginalFilename.*
 
-DEBUG = True
-
 from argparse import OPTIONAL
 import os
 import os.path
@@ -31,33 +29,81 @@ from enum import Enum
 import re
 import subprocess
 import json
+import stat
+import errno
+import contextlib
+import threading
+import concurrent.futures
+import functools
+import logging
+
+# the messages go through logging instead of print, so the module can be imported without side effects.
+# The debug messages are shown when the logging level is DEBUG, e.g. with the -v option of MediaFileProcess.py
+logger = logging.getLogger(__name__)
+
+# ffmpeg and moviepy are only checked when they are needed, not when the module is imported
+@functools.lru_cache(maxsize = None)
+def isFFmpegInstalled():
+    '''check if ffmpeg is installed and can be used through the subprocess module'''
+    try:
+        cmd = ['ffmpeg', '-version']
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        # Check for errors
+        if result.returncode != 0:
+            logger.warning(f"Error running ffmpeg: {result.stderr}")
+            return False
+        return True
+    except Exception as e:
+        logger.warning(f"Error: {e}")
+        return False
 
-# check if ffmpeg is installed and can be used through the subprocess module
-isFFmpegInstalled = False
-isMoviepyInstalled = False
-try:
-    cmd = ['ffmpeg', '-version']
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    # Check for errors
-    if result.returncode != 0:
-        print(f"Error running ffmpeg: {result.stderr}")
-    else:
-        isFFmpegInstalled = True
-except Exception as e:
-    print(f"Error: {e}")
-    isFFmpegInstalled = False
-# try to import moviepy, if failed, give a warning
-if isFFmpegInstalled:
+@functools.lru_cache(maxsize = None)
+def isMoviepyInstalled():
+    '''try to import moviepy, if failed, give a warning'''
     try:
         from moviepy.editor import VideoFileClip
-        isMoviepyInstalled = True
+        return True
     except Exception as e:
-        print(f"Error: {e}")
-        isMoviepyInstalled = False
-        print("Warning: moviepy is not installed. The video duration will be calculated by ffmpeg, which is not very efficient.")
+        logger.warning(f"Error: {e}")
+        logger.warning("Warning: moviepy is not installed. The video duration will be calculated by ffmpeg, which is not very efficient.")
+        return False
+
+# check if the dir_fd variants of the file operations are supported (not on Windows)
+isDirFdSupported = os.rename in os.supports_dir_fd \
+    and os.unlink in os.supports_dir_fd \
+    and os.stat in os.supports_dir_fd \
+    and os.utime in os.supports_dir_fd
 
 # ==================== The modules are prepared ====================
 
+# the listeners of the file operations, e.g. the library index.
+# Each listener has the methods onFileRenamed(oldFilePath, newFilePath) and onFileDeleted(filePath).
+# A listener might also have createCopyHasher(newFilePath), to get the bytes of the files copied across devices (see copyFileStreaming).
+# The file operations take the listenerList of their job (see MediaProcessConfig.fileOperationListenerList),
+# the global list below is only notified when no listenerList is given.
+fileOperationListenerList = []
+
+def addFileOperationListener(listener):
+    '''Add a listener which is notified of every file renamed, moved or deleted without a listenerList of its own'''
+    fileOperationListenerList.append(listener)
+
+def removeFileOperationListener(listener):
+    fileOperationListenerList.remove(listener)
+
+def getFileOperationListenerList(listenerList = None):
+    return fileOperationListenerList if listenerList is None else listenerList
+
+def notifyFileRenamed(oldFilePath, newFilePath, listenerList = None):
+    for listener in getFileOperationListenerList(listenerList):
+        listener.onFileRenamed(oldFilePath, newFilePath)
+
+def notifyFileDeleted(filePath, listenerList = None):
+    for listener in getFileOperationListenerList(listenerList):
+        listener.onFileDeleted(filePath)
+
+# the size of the chunks when the files are copied or hashed
+copyChunkSize = 1024 * 1024
+
 # the potential file extension for the video file
 videoFileExtensionList = [".MP4", ".MOV", ".MPG", ".MPEG", ".AVI", ".WMV", ".FLV", ".F4V", ".SWF", ".MKV", ".WEBM", ".HTML5"]
 imageFileExtensionList = [".JPG", ".JPEG", ".PNG", ".HEIC", ".GIF", ".BMP", ".TIFF", ".TIF", ".ICO", ".CUR", ".ANI", ".WEBP", ".CR2"]
@@ -65,6 +111,11 @@ imageFileExtensionList = [".JPG", ".JPEG", ".PNG", ".HEIC", ".GIF", ".BMP", ".TI
 uselessFileExtensionList = [".THM", ".LRV" # GoPro utility files
                             # might add more in the future
                             ]
+# the files which belong to a video or image file, they can be kept and renamed together with it.
+sidecarFileExtensionList = [".THM", ".LRV"]
+# the GoPro low resolution video GLPPSSSS.LRV belongs to the video GXPPSSSS.MP4 or GHPPSSSS.MP4
+goproLowResolutionStemPattern = r'^GL\d{6}$'
+goproVideoStemPattern = r'^G(H|X)\d{6}$'
 class FilenameType(Enum):
     '''The filename patterns for filenames without extensions'''
 
@@ -124,7 +175,7 @@ class FilenameType(Enum):
                         # OriginalFilename -> the original file name, string of any length.
 
 FilenamePattern = {
-    FilenameType.GxPPSSSS: r'^G(H|X)\d{4}$',
+    FilenameType.GxPPSSSS: r'^G(H|X)\d{6}$',
     FilenameType.IMG_SSSS: r'^IMG_\d{4}$',
     FilenameType.MVI_SSSS: r'^MVI_\d{4}$',
     FilenameType.DSCFSSSS: r'^DSCF\d{4}$',
@@ -151,51 +202,93 @@ class FileType(Enum):
     Image = 2
     KnownButUseless = 3
 
+class FileContentStatus(Enum):
+    '''the content status of the file, sniffed from the head and the tail of the file'''
+    Unknown = 0     # the format is not recognized, so nothing can be told
+    Valid = 1
+    Empty = 2
+    Corrupted = 3   # proven truncated, the last MP4 box goes beyond the end of the file, or there is mdat but no moov
+
+# the bytes read from the head and the tail of the file to sniff the content
+sniffSize = 4096
+# the top level box types which can start an ISO media file (MP4, MOV, HEIC), old QuickTime files might not start with ftyp
+isoBoxTypeList = [b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pnot", b"uuid"]
+# the ftyp brands of the HEIF images, the others are videos
+heicBrandList = [b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx", b"mif1", b"msf1", b"avif"]
+# stop walking the boxes of a broken file
+maximumIsoBoxCount = 1000
+
+class RestoreConflictPolicy(Enum):
+    '''What to do when several files are restored to the same original filename, e.g. IMG_0001 from two iPhones'''
+    Skip = "skip"                   # the later files keep their formatted names
+    Suffix = "suffix"               # the later files get a unique ID, like IMG_0001_02.JPG
+    CameraSubFolder = "camera"      # the later files go into the sub folder named after their camera ID
+
+class DestinationLayout(Enum):
+    '''The sub folder layout in the destination folder, based on the captured date and the camera ID'''
+    Flat = "flat"                   # all the files are in the destination folder
+    YYYY = "YYYY"                   # destination/2023/
+    YYYY_MM = "YYYY/MM"             # destination/2023/07/
+    YYYY_MM_DD = "YYYY/MM/DD"       # destination/2023/07/15/
+    Camera_YYYY_MM = "camera/YYYY-MM" # destination/GoPro9/2023-07/
+
+def getLayoutSubFolder(capturedDate, cameraID, layout = DestinationLayout.Flat):
+    '''Get the sub folder (relative to the destination folder) of the file.
+    capturedDate is in the format of YYYYMMDD. Return "" for the flat layout.'''
+    year, month, day = capturedDate[0:4], capturedDate[4:6], capturedDate[6:8]
+    if layout == DestinationLayout.YYYY:
+        return year
+    elif layout == DestinationLayout.YYYY_MM:
+        return os.path.join(year, month)
+    elif layout == DestinationLayout.YYYY_MM_DD:
+        return os.path.join(year, month, day)
+    elif layout == DestinationLayout.Camera_YYYY_MM:
+        return os.path.join(cameraID, year + "-" + month)
+    else:
+        return ""
+
 # ==================== Functions to get the file information ====================
-def getModifiedDateAndTime(filePath):
-    '''Get the modified date and time of the file. 
+def formatDateAndTime(timeBySeconds):
+    '''Format the time in seconds since the epoch as two strings in the format of YYYYMMDD, HHMMSSTT'''
+    dateTime = datetime.datetime.fromtimestamp(timeBySeconds)
+    return dateTime.strftime("%Y%m%d"), dateTime.strftime("%H%M%S") + format(timeBySeconds % 1, ".6f")[2:4]
+
+def getModifiedDateAndTime(filePath, timeOffsetInNanoseconds = 0):
+    '''Get the modified date and time of the file, shifted by the time offset. 
     Return two strings in the format of YYYYMMDD, HHMMSSTT'''
     # modifiedDate is the date of the file in the format of YYYYMMDD
     # modifiedTime is the time of the file in the format of HHMMSS
 
     # get the modified time of the file in seconds since the epoch
-    fileModifiedTimeBySeconds = os.path.getmtime(filePath)
-    # convert the modified time to a datetime object
-    fileModifiedDateTime = datetime.datetime.fromtimestamp(fileModifiedTimeBySeconds)
-    # extract the date in the format of YYYYMMDD
-    extractedDate = fileModifiedDateTime.strftime("%Y%m%d")
-    # extract the time in the format of HHMMSSTT
-    extractedTime = fileModifiedDateTime.strftime("%H%M%S")
-    timeLessThanOneSecond = fileModifiedTimeBySeconds % 1
-    extractedTime = extractedTime + format(timeLessThanOneSecond, ".6f")[2:4]
+    if timeOffsetInNanoseconds == 0:
+        fileModifiedTimeBySeconds = os.path.getmtime(filePath)
+    else:
+        fileModifiedTimeBySeconds = (os.stat(filePath).st_mtime_ns + timeOffsetInNanoseconds) / 1e9
+    # extract the date in the format of YYYYMMDD, and the time in the format of HHMMSSTT
+    extractedDate, extractedTime = formatDateAndTime(fileModifiedTimeBySeconds)
 
-    if DEBUG:
-        print("File name is: " + filePath)
-        print("The modified time of the file is: " + extractedDate)
-        print("The modified date of the file is: " + extractedTime)
+    logger.debug("File name is: " + filePath)
+    logger.debug("The modified time of the file is: " + extractedDate)
+    logger.debug("The modified date of the file is: " + extractedTime)
     return extractedDate, extractedTime
 
-def getCreationDateAndTime(filePath):
-    '''Get the created date and time of the file. 
+def getCreationDateAndTime(filePath, timeOffsetInNanoseconds = 0):
+    '''Get the created date and time of the file, shifted by the time offset. 
     Return two strings in the format of YYYYMMDD, HHMMSSTT'''
     # createdDate is the date of the file in the format of YYYYMMDD
     # createdTime is the time of the file in the format of HHMMSS
 
     # get the creation time of the file in seconds since the epoch
-    fileModificationTimeBySeconds = os.path.getctime(filePath)
-    # convert the creation time to a datetime object
-    fileCreationDateTime = datetime.datetime.fromtimestamp(fileModificationTimeBySeconds)
-    # extract the date in the format of YYYYMMDD
-    extractedDate = fileCreationDateTime.strftime("%Y%m%d")
-    # extract the time in the format of HHMMSSTT
-    extractedTime = fileCreationDateTime.strftime("%H%M%S")
-    timeLessThanOneSecond = fileModificationTimeBySeconds % 1
-    extractedTime = extractedTime + format(timeLessThanOneSecond, ".6f")[2:4]
+    if timeOffsetInNanoseconds == 0:
+        fileModificationTimeBySeconds = os.path.getctime(filePath)
+    else:
+        fileModificationTimeBySeconds = (os.stat(filePath).st_ctime_ns + timeOffsetInNanoseconds) / 1e9
+    # extract the date in the format of YYYYMMDD, and the time in the format of HHMMSSTT
+    extractedDate, extractedTime = formatDateAndTime(fileModificationTimeBySeconds)
 
-    if DEBUG:
-        print("File name is: " + filePath)
-        print("The created time of the file is: " + extractedDate)
-        print("The created date of the file is: " + extractedTime)
+    logger.debug("File name is: " + filePath)
+    logger.debug("The created time of the file is: " + extractedDate)
+    logger.debug("The created date of the file is: " + extractedTime)
     return extractedDate, extractedTime
 
 def getModifiedDateTime(filePath):
@@ -212,18 +305,17 @@ def getModifiedDateTime(filePath):
     timeLessThanOneSecond = fileModifiedTimeBySeconds % 1
     extractedTime = extractedTime + format(timeLessThanOneSecond, ".6f")[2:4]
     
-    if DEBUG:
-        print("File name is: " + filePath)
-        print("The modified date and time of the file is: " + extractedDate + "_" + extractedTime)
+    logger.debug("File name is: " + filePath)
+    logger.debug("The modified date and time of the file is: " + extractedDate + "_" + extractedTime)
     return fileModifiedDateTime
 
-def getVideoCapturedDateAndTime(filePath, isUseModifiedTime = False):
-    '''Get the date and time when the video was created. 
+def getVideoCapturedDateAndTime(filePath, isUseModifiedTime = False, timeOffsetInNanoseconds = 0):
+    '''Get the date and time when the video was created, shifted by the time offset. 
     Return two strings in the format of YYYYMMDD, HHMMSSTT'''
     if isUseModifiedTime:
-        return getModifiedDateAndTime(filePath)
+        return getModifiedDateAndTime(filePath, timeOffsetInNanoseconds)
     else: 
-        return getCreationDateAndTime(filePath)
+        return getCreationDateAndTime(filePath, timeOffsetInNanoseconds)
 
 
 # def getVideoCapturedDateAndTime_FromModificatingTime(filePath):
@@ -232,7 +324,7 @@ def getVideoCapturedDateAndTime(filePath, isUseModifiedTime = False):
     
 #     videoDurationBySeconds = None
 #     # get video duration by seconds
-#     if isFFmpegInstalled:
+#     if isFFmpegInstalled():
 #         # get the duration of the video in seconds through ffmpeg
 #         result = subprocess.run(['ffprobe', 
 #                                 '-v', 
@@ -245,11 +337,12 @@ def getVideoCapturedDateAndTime(filePath, isUseModifiedTime = False):
 #                                 stdout=subprocess.PIPE, 
 #                                 stderr=subprocess.STDOUT)
 #         videoDurationBySeconds = float(result.stdout)
-#     elif isMoviepyInstalled:
+#     elif isMoviepyInstalled():
+#         from moviepy.editor import VideoFileClip
 #         # use moviepy to get the video duration, not very efficient
 #         videoDurationBySeconds = VideoFileClip(filePath).duration
 #     else:
-#         print("Error: ffmpeg and moviepy are not installed, so modified time is used instead of capture starting time.")
+#         logger.warning("Error: ffmpeg and moviepy are not installed, so modified time is used instead of capture starting time.")
 #         videoDurationBySeconds = 0.0
 
 #     # get the modified time of the file in seconds since the epoch
@@ -263,10 +356,9 @@ def getVideoCapturedDateAndTime(filePath, isUseModifiedTime = False):
 #     extractedDate = videoCapturedDateTime.strftime("%Y%m%d")
 #     # extract the time in the format of HHMMSSTT, in 24-hour format
 #     extractedTime = videoCapturedDateTime.strftime("%H%M%S") + format(videoCapturedTimeBySecondsDecimalPart, ".6f")[2:4]
-#     if DEBUG:
-#         print("File name is: " + filePath)
-#         print("The captured date of the video is: " + extractedTime)
-#         print("The captured time of the video is: " + extractedDate)
+#     logger.debug("File name is: " + filePath)
+#     logger.debug("The captured date of the video is: " + extractedTime)
+#     logger.debug("The captured time of the video is: " + extractedDate)
 #     return extractedDate, extractedTime
 
 
@@ -280,13 +372,13 @@ def getFileMetadata(filePath):
 
         # Check for errors
         if result.returncode != 0:
-            print(f"Error running exiftool: {result.stderr}")
+            logger.warning(f"Error running exiftool: {result.stderr}")
             return None
         # Parse the JSON output
         metadata = json.loads(result.stdout)
         return metadata
     except Exception as e:
-        print(f"Error: {e}")
+        logger.warning(f"Error: {e}")
         return None
 
 # ==================== Functions to check the file and type ====================
@@ -321,80 +413,459 @@ def isUselessFile(filePath):
     '''check if the filename extension is in the uselessFileExtensionList'''
     filenameWithExtension = os.path.basename(filePath)
     if os.path.splitext(filenameWithExtension)[1].upper() in uselessFileExtensionList:
-        if DEBUG:
-            print("The file " + filenameWithExtension + " is most likely a GoPro utility file.")
+        logger.debug("The file " + filenameWithExtension + " is most likely a GoPro utility file.")
         return True
 
+def isSidecarFile(filePath):
+    '''check if the file is a sidecar file (thumbnail, low resolution proxy) which belongs to a video or image file'''
+    return os.path.splitext(filePath)[1].upper() in sidecarFileExtensionList
+
+def getSidecarPrimaryStemList(sidecarFilenameWithoutExtension):
+    '''Get the possible filenames (without extension) of the primary file of the sidecar file.
+    GoPro low resolution videos are named as GLPPSSSS.LRV for the GXPPSSSS.MP4 or GHPPSSSS.MP4 videos.'''
+    if validateString(goproLowResolutionStemPattern, sidecarFilenameWithoutExtension):
+        return ["GX" + sidecarFilenameWithoutExtension[2:], "GH" + sidecarFilenameWithoutExtension[2:]]
+    return [sidecarFilenameWithoutExtension]
+
+def getSidecarStemList(primaryFilenameWithoutExtension):
+    '''Get the possible filenames (without extension) of the sidecar files of the primary file, the reverse of getSidecarPrimaryStemList'''
+    if validateString(goproVideoStemPattern, primaryFilenameWithoutExtension):
+        return [primaryFilenameWithoutExtension, "GL" + primaryFilenameWithoutExtension[2:]]
+    return [primaryFilenameWithoutExtension]
+
+def getSidecarFormattedFilename(formattedFilename, sidecarFilename):
+    '''Get the new name of the sidecar file, which shares the formatted name of its primary file'''
+    return os.path.splitext(formattedFilename)[0] + os.path.splitext(sidecarFilename)[1]
+
+def getSidecarOriginalFilename(restoredFilename):
+    '''Get the original name of a restored sidecar file, the GoPro low resolution videos are named GL again.'''
+    filenameWithoutExtension, fileExtension = os.path.splitext(restoredFilename)
+    if fileExtension.upper() == ".LRV" and validateString(goproVideoStemPattern, filenameWithoutExtension):
+        return "GL" + filenameWithoutExtension[2:] + fileExtension
+    return restoredFilename
+
+class SidecarIndex:
+    '''The sidecar files keyed by (folder, stem of the primary file).
+    The index is built in one pass over the folder, so pairing is O(n) instead of matching per file.'''
+    def __init__(self):
+        self.sidecarFilenameDict = {}
+
+    def addFolder(self, folderPath, skipFunction = None, trashFunction = None):
+        '''Add the sidecar files in the folder to the index. Return the other filenames in the folder.
+        The files for which skipFunction(entry) is True are left out (see getFormattedInPlaceSkipFunction),
+        their sidecar files stay where they are. The files deleted by trashFunction(entry) are left out too (see getTrashFunction).'''
+        primaryFilenameList = []
+        primaryStemSet = set()
+        sidecarFilenameList = []
+        with os.scandir(folderPath) as entries:
+            for entry in entries:
+                if trashFunction is not None and trashFunction(entry):
+                    continue
+                if isSidecarFile(entry.name):
+                    sidecarFilenameList.append(entry.name)
+                else:
+                    if skipFunction is None or not skipFunction(entry):
+                        primaryFilenameList.append(entry.name)
+                    primaryStemSet.add(os.path.splitext(entry.name)[0])
+        for sidecarFilename in sidecarFilenameList:
+            for primaryStem in getSidecarPrimaryStemList(os.path.splitext(sidecarFilename)[0]):
+                if primaryStem in primaryStemSet:
+                    self.sidecarFilenameDict.setdefault((folderPath, primaryStem), []).append(sidecarFilename)
+                    break
+            else:
+                # the sidecar file without a primary file stays where it is
+                logger.debug("The sidecar file " + sidecarFilename + " has no primary file.")
+        return primaryFilenameList
+
+    def getSidecarFilenameList(self, folderPath, primaryFilename):
+        '''Get the sidecar filenames of the primary file'''
+        return self.sidecarFilenameDict.get((folderPath, os.path.splitext(primaryFilename)[0]), [])
+
+# ==================== Functions to sniff the file content ====================
+def readFileAt(fd, size, offset):
+    '''Read size bytes at offset of the opened file, without moving the file position if pread is supported'''
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def sniffIsoMediaFile(fd, fileSize, head):
+    '''Walk the top level boxes of an ISO media file (MP4, MOV, HEIC). Return the FileType and the FileContentStatus.
+    Only the box headers are read, the boxes in the head are not read again.
+    The file is Corrupted only if its truncation is proven, as the corrupted files are deleted.'''
+    offset = 0
+    brand = None
+    boxTypeSet = set()
+    # if the walk stops before the end of the file, the rest of the file is not known
+    isWalkedToEnd = False
+    for i in range(maximumIsoBoxCount):
+        if offset >= fileSize:
+            isWalkedToEnd = True
+            break
+        header = head[offset:offset + 16] if offset + 16 <= len(head) else readFileAt(fd, 16, offset)
+        if len(header) < 8:
+            # a few padding bytes after the last box, not a box
+            break
+        boxSize = int.from_bytes(header[0:4], "big")
+        boxType = header[4:8]
+        if boxSize == 1:
+            # the 64-bit box size follows the box type
+            if len(header) < 16:
+                break
+            boxSize = int.from_bytes(header[8:16], "big")
+        elif boxSize == 0:
+            # the box extends to the end of the file
+            boxSize = fileSize - offset
+        if boxSize < 8:
+            # not a box header
+            break
+        if boxType == b"ftyp":
+            brand = header[8:12]
+        boxTypeSet.add(boxType)
+        offset = offset + boxSize
+
+    if brand in heicBrandList:
+        fileType = FileType.Image
+        isComplete = b"meta" in boxTypeSet
+    else:
+        fileType = FileType.Video
+        isComplete = b"moov" in boxTypeSet
+    # the last box going beyond the end of the file means the file is truncated
+    if offset > fileSize:
+        return fileType, FileContentStatus.Corrupted
+    if isComplete:
+        return fileType, FileContentStatus.Valid
+    # the media data is there, but the whole file is walked and its index (moov or meta) is not
+    if isWalkedToEnd and b"mdat" in boxTypeSet:
+        return fileType, FileContentStatus.Corrupted
+    return fileType, FileContentStatus.Unknown
+
+def sniffFile(folderPath, filename, folderFd = None):
+    '''Sniff the file content from the first and last few KB of the file. 
+    Return the FileType and the FileContentStatus, FileType.Unknown if the format is not recognized.'''
+    fd = os.open(getPathInFolder(folderPath, filename, folderFd), os.O_RDONLY | getattr(os, "O_BINARY", 0), dir_fd = folderFd)
+    try:
+        fileSize = os.fstat(fd).st_size
+        if fileSize == 0:
+            return FileType.Unknown, FileContentStatus.Empty
+        head = readFileAt(fd, sniffSize, 0)
+        if head.startswith(b"\xff\xd8\xff"):
+            # JPEG, the end of image marker is usually in the tail. It is not a proof of truncation if it is not there,
+            # the motion photos (Samsung, Google) embed a video after it, and the maker notes can add more data.
+            tail = head if fileSize <= sniffSize else readFileAt(fd, sniffSize, fileSize - sniffSize)
+            return FileType.Image, FileContentStatus.Valid if b"\xff\xd9" in tail else FileContentStatus.Unknown
+        elif head.startswith(b"\x89PNG\r\n\x1a\n"):
+            # the same for the data appended after the PNG end chunk
+            tail = head if fileSize <= sniffSize else readFileAt(fd, sniffSize, fileSize - sniffSize)
+            return FileType.Image, FileContentStatus.Valid if b"IEND" in tail else FileContentStatus.Unknown
+        elif head[4:8] in isoBoxTypeList:
+            return sniffIsoMediaFile(fd, fileSize, head)
+        return FileType.Unknown, FileContentStatus.Unknown
+    finally:
+        os.close(fd)
+
+def sniffFilesInFolder(folderPath, filenameList = None, maxWorkers = 8):
+    '''Sniff the files in the folder in parallel. By default, all the video and image files are sniffed.
+    Return a dict of file path -> (FileType, FileContentStatus).'''
+    if filenameList is None:
+        filenameList = [filename for filename in os.listdir(folderPath) if isVideoOrImageFile(filename)]
+    with openFolderFd(folderPath) as folderFd:
+        def sniff(filename):
+            try:
+                return sniffFile(folderPath, filename, folderFd)
+            except OSError as e:
+                logger.debug("Error: " + str(e))
+                return FileType.Unknown, FileContentStatus.Unknown
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+            sniffResultList = list(executor.map(sniff, filenameList))
+    return dict(zip((os.path.join(folderPath, filename) for filename in filenameList), sniffResultList))
+
+def getFileType(filePath, sniffResultDict = None):
+    '''Get the FileType of the file, from the sniffed content if it is known, otherwise from the extension.'''
+    if sniffResultDict is not None:
+        fileType, fileContentStatus = sniffResultDict.get(filePath, (FileType.Unknown, FileContentStatus.Unknown))
+        if fileType != FileType.Unknown:
+            return fileType
+    if isVideoFile(filePath):
+        return FileType.Video
+    elif isImageFile(filePath):
+        return FileType.Image
+    elif isUselessFile(filePath):
+        return FileType.KnownButUseless
+    return FileType.Unknown
+
 # ==================== More of the general functions ====================
+@contextlib.contextmanager
+def openFolderFd(folderPath):
+    '''Open the folder once and yield its file descriptor, so the file operations inside the folder
+    do not make the kernel resolve the full path again and again.
+    Yield None if dir_fd is not supported, and the operations fall back to the full paths.'''
+    if not isDirFdSupported:
+        yield None
+        return
+    folderFd = os.open(folderPath, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        yield folderFd
+    finally:
+        os.close(folderFd)
+
+def getPathInFolder(folderPath, filename, folderFd = None):
+    '''Get the path used by the file operations. 
+    If the folder is opened as folderFd, the filename relative to the folder is enough.'''
+    if folderFd is not None:
+        return filename
+    return os.path.join(folderPath, filename)
+
+def isFileInFolder(folderPath, filename, folderFd = None):
+    '''check if the file exists in the folder, through the folder fd if it is given.'''
+    try:
+        return stat.S_ISREG(os.stat(getPathInFolder(folderPath, filename, folderFd), dir_fd = folderFd).st_mode)
+    except OSError:
+        return False
+
+def getFileSizeInFolder(folderPath, filename, folderFd = None):
+    '''Get the size of the file in the folder, through the folder fd if it is given. Return 0 if the file does not exist.'''
+    try:
+        return os.stat(getPathInFolder(folderPath, filename, folderFd), dir_fd = folderFd).st_size
+    except OSError:
+        return 0
+
+def isSameFileInFolder(filePath, folderPath, filename, folderFd = None):
+    '''check if the file in the folder is the same file with filePath, like os.path.samefile.
+    Return False if any of the files does not exist (yet).'''
+    try:
+        return os.path.samestat(os.stat(filePath), os.stat(getPathInFolder(folderPath, filename, folderFd), dir_fd = folderFd))
+    except OSError:
+        return False
+
+def listFolderFilenameSet(folderPath):
+    '''Create the folder if needed, and get the set of the filenames in it'''
+    os.makedirs(folderPath, exist_ok = True)
+    with os.scandir(folderPath) as entries:
+        return set(entry.name for entry in entries)
+
+class LocalDestinationBackend:
+    '''The destination folder on the local file system, the default backend of the destination.
+    A backend lists the names in a sub folder of the destination, checks if a name is already the same file,
+    and moves a file to its new name. The other backends (e.g. an S3 bucket) are in DestinationBackend.py.'''
+    isLocal = True
+
+    def __init__(self, destinationFolderPath):
+        self.destinationFolderPath = destinationFolderPath
+
+    def getLocation(self, relativePath):
+        return os.path.join(self.destinationFolderPath, relativePath)
+
+    def listFolder(self, subFolder):
+        '''Get the set of the filenames in the sub folder, the sub folder is created if needed'''
+        return listFolderFilenameSet(os.path.join(self.destinationFolderPath, subFolder))
+
+    def isFile(self, relativePath, destinationFolderFd = None):
+        return isFileInFolder(self.destinationFolderPath, relativePath, destinationFolderFd)
+
+    def isSameFile(self, filePath, relativePath, destinationFolderFd = None):
+        return isSameFileInFolder(filePath, self.destinationFolderPath, relativePath, destinationFolderFd)
+
+    def moveFile(self, sourceFolderPath, filename, relativePath, sourceFolderFd = None, destinationFolderFd = None, listenerList = None):
+        '''Move the file to the relative path in the destination folder. Return the new file path.
+        Raise FileExistsError if the relative path is taken.
+        The listeners of listenerList get the bytes of the files copied across devices, see copyFileStreaming.'''
+        if isFileInFolder(self.destinationFolderPath, relativePath, destinationFolderFd):
+            raise FileExistsError("The file " + relativePath + " already exists in the destination folder " + self.destinationFolderPath + ".")
+        moveFileBetweenFolders(sourceFolderPath, filename, self.destinationFolderPath, relativePath, sourceFolderFd, destinationFolderFd, listenerList)
+        return self.getLocation(relativePath)
+
+class DestinationFolderIndex:
+    '''The in-memory filename index of the destination folder, one filename set per sub folder.
+    Each sub folder is created and listed only once, when the first file is going into it,
+    so the collision checks do not touch the file system.
+    The sub folders are listed through destinationBackend, the local folder (LocalDestinationBackend) if it is not given.'''
+    def __init__(self, destinationFolderPath, destinationBackend = None):
+        self.destinationFolderPath = destinationFolderPath
+        self.destinationBackend = LocalDestinationBackend(destinationFolderPath) if destinationBackend is None else destinationBackend
+        self.filenameSetDict = {}
+        self.lock = threading.Lock()
+
+    def getFilenameSet(self, subFolder):
+        '''Get the filename set of the sub folder. Create and list the sub folder if it is the first time.'''
+        filenameSet = self.filenameSetDict.get(subFolder)
+        if filenameSet is None:
+            filenameSet = self.filenameSetDict[subFolder] = self.destinationBackend.listFolder(subFolder)
+        return filenameSet
+
+    def isSameFile(self, filePath, subFolder, filename, destinationFolderFd = None):
+        '''check if the file in the sub folder of the destination is the same with filePath, like isSameFileInFolder'''
+        return self.destinationBackend.isSameFile(filePath, os.path.join(subFolder, filename), destinationFolderFd)
+
+    def isFilenameTaken(self, subFolder, filename):
+        '''check if the filename is already used in the sub folder'''
+        with self.lock:
+            return filename in self.getFilenameSet(subFolder)
+
+    def reserveFilename(self, subFolder, filename):
+        '''Take the filename in the sub folder. Return False if it is already taken.'''
+        with self.lock:
+            filenameSet = self.getFilenameSet(subFolder)
+            if filename in filenameSet:
+                return False
+            filenameSet.add(filename)
+            return True
+
+    def releaseFilename(self, subFolder, filename):
+        '''Give the filename in the sub folder back, e.g. when the file is renamed or moved away.'''
+        with self.lock:
+            self.getFilenameSet(subFolder).discard(filename)
+
+def moveFileBetweenFolders(sourceFolderPath, filename, destinationFolderPath, newFilename = None, 
+                           sourceFolderFd = None, destinationFolderFd = None, listenerList = None):
+    '''Move the file from the source folder to the destination folder.
+    Use rename with the folder fds, and fall back to shutil.move when the folders are on different devices.'''
+    newFilename = filename if newFilename is None else newFilename
+    try:
+        os.rename(getPathInFolder(sourceFolderPath, filename, sourceFolderFd),
+                  getPathInFolder(destinationFolderPath, newFilename, destinationFolderFd),
+                  src_dir_fd = sourceFolderFd, dst_dir_fd = destinationFolderFd)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(os.path.join(sourceFolderPath, filename), os.path.join(destinationFolderPath, newFilename), 
+                    copy_function = functools.partial(copyFileStreaming, listenerList = listenerList))
+
+def copyFileStreaming(sourcePath, destinationPath, listenerList = None):
+    '''Copy the file, the copy_function of shutil.move across devices.
+    The listeners with createCopyHasher(destinationPath) get every chunk of the bytes while they are copied,
+    e.g. the checksum manifest, so the file is not read again. Without such listeners, shutil.copy2 is used.'''
+    hasherList = [listener.createCopyHasher(destinationPath) for listener in getFileOperationListenerList(listenerList) 
+                  if hasattr(listener, "createCopyHasher")]
+    hasherList = [hasher for hasher in hasherList if hasher is not None]
+    if not hasherList:
+        return shutil.copy2(sourcePath, destinationPath)
+    with open(sourcePath, "rb") as sourceFile, open(destinationPath, "wb") as destinationFile:
+        while True:
+            chunk = sourceFile.read(copyChunkSize)
+            if not chunk:
+                break
+            destinationFile.write(chunk)
+            for hasher in hasherList:
+                hasher.update(chunk)
+    shutil.copystat(sourcePath, destinationPath)
+    return destinationPath
+
 def isThereSubFolder(folderPath):
     '''check if there is any sub folder in the folder'''
-    for filename in os.listdir(folderPath):
-        if os.path.isdir(os.path.join(folderPath, filename)):
-            return True
+    with os.scandir(folderPath) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                return True
     return False
 
 def isAirdropSubFolder(folderPath):
     '''check if the folder is an airdrop sub folder, which contains only one file sharing the same name (without extension) with the folder.'''
-    # check if the folder only contains one file
-    if len(os.listdir(folderPath)) == 1:
-        # check if the file name is the same with the folder name
-        if os.path.basename(folderPath) == os.path.splitext(os.listdir(folderPath)[0])[0]:
-            return True
-    return False
+    return isAirdropFilenameList(os.path.basename(folderPath), os.listdir(folderPath))
+
+def isAirdropFilenameList(folderName, filenameList):
+    '''check if the content of the folder looks like an airdrop sub folder: only one file with the same name as the folder.'''
+    return len(filenameList) == 1 and folderName == os.path.splitext(filenameList[0])[0]
 
 def isThereAirdropSubFolder(folderPath):
     '''check if there is any airdrop sub folder in the folder'''
-    for filename in os.listdir(folderPath):
-        if os.path.isdir(os.path.join(folderPath, filename)):
-            if isAirdropSubFolder(os.path.join(folderPath, filename)):
-                return True
-    return False
+    airdropSubFolderDict, otherSubFolderDict = scanSubFolders(folderPath)
+    return len(airdropSubFolderDict) > 0
+
+def scanSubFolders(folderPath):
+    '''Scan the sub folders of the folder in one scandir pass, each sub folder is listed only once.
+    Return two dicts of sub folder name -> filename list, for airdrop sub folders and other sub folders.'''
+    airdropSubFolderDict = {}
+    otherSubFolderDict = {}
+    with os.scandir(folderPath) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            filenameList = os.listdir(entry.path)
+            if isAirdropFilenameList(entry.name, filenameList):
+                airdropSubFolderDict[entry.name] = filenameList
+            else:
+                otherSubFolderDict[entry.name] = filenameList
+    return airdropSubFolderDict, otherSubFolderDict
 
 def getSubFolderListAsAirdropSubFolderListAndOtherSubFolderList(folderPath):
     '''get the sub folder list in the folder, and divide them into two lists, airdrop sub folders and other sub folders.'''
-    airdropSubFolderList = []
-    otherSubFolderList = []
-    for filename in os.listdir(folderPath):
-        if os.path.isdir(os.path.join(folderPath, filename)):
-            if isAirdropSubFolder(os.path.join(folderPath, filename)):
-                airdropSubFolderList.append(filename)
-            else:
-                otherSubFolderList.append(filename)
-    return airdropSubFolderList, otherSubFolderList
+    airdropSubFolderDict, otherSubFolderDict = scanSubFolders(folderPath)
+    return list(airdropSubFolderDict), list(otherSubFolderDict)
 
 def getSubFolderList(folderPath):
     '''get the sub folder list in the folder.'''
     subFolderList = []
-    for filename in os.listdir(folderPath):
-        if os.path.isdir(os.path.join(folderPath, filename)):
-            subFolderList.append(filename)
+    with os.scandir(folderPath) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subFolderList.append(entry.name)
     return subFolderList
 
-def mergeAirdropSubFolders(sourceFolderPath, destinationFolderPath = None):
+def reserveMergedFilename(destinationFolderIndex, filename, subFolder = ""):
+    '''Reserve the filename in the (sub folder of the) destination folder index. 
+    If it is taken, add a unique ID to it, like IMG_0001_02.JPG. Return the reserved filename.'''
+    filenameWithoutExtension, fileExtension = os.path.splitext(filename)
+    newFilename = filename
+    uniqueID = 1
+    while not destinationFolderIndex.reserveFilename(subFolder, newFilename):
+        uniqueID = uniqueID + 1
+        newFilename = filenameWithoutExtension + "_" + str(uniqueID).zfill(2) + fileExtension
+    return newFilename
+
+def mergeSubFolderDict(sourceFolderPath, subFolderDict, destinationFolderPath, maxWorkers = 8, listenerList = None):
+    '''Move the content of the sub folders (sub folder name -> filename list) to the destination folder in parallel, 
+    and delete the sub folders. The name collisions are resolved in memory by adding a unique ID.
+    The files are renamed if the folders are on the same device, otherwise they are moved (copied).'''
+    if len(subFolderDict) == 0:
+        return
+    os.makedirs(destinationFolderPath, exist_ok = True)
+    isSameDevice = os.stat(sourceFolderPath).st_dev == os.stat(destinationFolderPath).st_dev
+    destinationFolderIndex = DestinationFolderIndex(destinationFolderPath)
+    # plan all the moves first, so the name collisions are decided before anything is moved
+    moveList = []
+    for subFolderName, filenameList in subFolderDict.items():
+        for filename in filenameList:
+            moveList.append((os.path.join(subFolderName, filename), reserveMergedFilename(destinationFolderIndex, filename)))
+
+    with openFolderFd(sourceFolderPath) as sourceFolderFd, openFolderFd(destinationFolderPath) as destinationFolderFd:
+        def moveFile(move):
+            filePathInSourceFolder, newFilename = move
+            if isSameDevice:
+                moveFileBetweenFolders(sourceFolderPath, filePathInSourceFolder, destinationFolderPath, newFilename, 
+                                       sourceFolderFd, destinationFolderFd, listenerList)
+            else:
+                shutil.move(os.path.join(sourceFolderPath, filePathInSourceFolder), os.path.join(destinationFolderPath, newFilename),
+                            copy_function = functools.partial(copyFileStreaming, listenerList = listenerList))
+            notifyFileRenamed(os.path.join(sourceFolderPath, filePathInSourceFolder), os.path.join(destinationFolderPath, newFilename), listenerList)
+            if newFilename != os.path.basename(filePathInSourceFolder):
+                logger.debug("The file " + filePathInSourceFolder + " is renamed to " + newFilename + " to avoid the name collision.")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+            # list() to raise the errors of the moves
+            list(executor.map(moveFile, moveList))
+    # delete the sub folders
+    for subFolderName in subFolderDict:
+        os.rmdir(os.path.join(sourceFolderPath, subFolderName))
+
+def mergeAirdropSubFolders(sourceFolderPath, destinationFolderPath = None, maxWorkers = 8, listenerList = None):
     '''Move the content of the airdrop subfolders of the source folder to the destination folder, and delete the sub folders.'''
     destinationFolderPath = sourceFolderPath if destinationFolderPath is None else destinationFolderPath
-    # get the sub folder list
-    airdropSubFolderList, otherSubFolderList = getSubFolderListAsAirdropSubFolderListAndOtherSubFolderList(sourceFolderPath)
+    # get the sub folder list, with their content
+    airdropSubFolderDict, otherSubFolderDict = scanSubFolders(sourceFolderPath)
     # move the content of the airdrop sub folder to the destination folder
-    for subFolderName in airdropSubFolderList:
-        subFolderPath = os.path.join(sourceFolderPath, subFolderName)
-        for filename in os.listdir(subFolderPath):
-            shutil.move(os.path.join(subFolderPath, filename), os.path.join(destinationFolderPath, filename))
-        # delete the sub folder
-        os.rmdir(subFolderPath)
-
-def mergeSubFolders(sourceFolderPath, destinationFolderPath = None):
+    mergeSubFolderDict(sourceFolderPath, airdropSubFolderDict, destinationFolderPath, maxWorkers, listenerList)
+
+def mergeSubFolders(sourceFolderPath, destinationFolderPath = None, maxWorkers = 8, listenerList = None):
     '''Move the content of the subfolders of the source folder to the destination folder, and delete the sub folders.'''
     destinationFolderPath = sourceFolderPath if destinationFolderPath is None else destinationFolderPath
-    # get the sub folder list
-    subFolderList = getSubFolderList(sourceFolderPath)
+    # get the sub folder list, with their content
+    airdropSubFolderDict, otherSubFolderDict = scanSubFolders(sourceFolderPath)
+    subFolderDict = dict(airdropSubFolderDict)
+    subFolderDict.update(otherSubFolderDict)
     # move the content of the sub folder to the destination folder
-    for subFolderName in subFolderList:
-        subFolderPath = os.path.join(sourceFolderPath, subFolderName)
-        for filename in os.listdir(subFolderPath):
-            shutil.move(os.path.join(subFolderPath, filename), os.path.join(destinationFolderPath, filename))
-        # delete the sub folder
-        os.rmdir(subFolderPath)
+    mergeSubFolderDict(sourceFolderPath, subFolderDict, destinationFolderPath, maxWorkers, listenerList)
 
 def getFilenameListExcludingFileExtension(folderPath, fileExtension, isCaseSensitive = False):
     ''' Get the file name list in the folder, excluding the file extension.'''
@@ -455,86 +926,218 @@ def getFilePathListByFileExtension(folderPath, fileExtension, isCaseSensitive =
                 filePathList.append(os.path.join(folderPath, filename))
     return filePathList
 
-def chageFileModificationDateAndTime(filePath, timeOffseInSeconds = 0):
-    '''Change the modification date and time of the file. Mac OS does not support this.'''
-    # get the modification time of the file in seconds
-    fileModificationTimeBySeconds = os.path.getmtime(filePath)
-    # add the time offset to the modification time
-    fileModificationTimeBySeconds += timeOffseInSeconds
-    # change the modification time of the file
-    os.utime(filePath, (fileModificationTimeBySeconds, fileModificationTimeBySeconds))
-
-
-def changeFileCreationTimeInFolder(folderPath, sourceTimeStamp, destinationTimeStamp):
+def chageFileModificationDateAndTime(filePath, timeOffseInSeconds = 0, folderFd = None):
+    '''Change the modification date and time of the file. Mac OS does not support this.
+    If folderFd is given, filePath is the filename relative to the opened folder.'''
+    # shift the time in nanoseconds, the float seconds lose the precision
+    shiftFileTimeInFolder(os.path.dirname(filePath), os.path.basename(filePath), round(timeOffseInSeconds * 1e9), folderFd)
+
+def shiftFileTimeInFolder(folderPath, filename, timeOffsetInNanoseconds, folderFd = None):
+    '''Shift the modification time of the file in the folder by the offset in nanoseconds, keeping the access time'''
+    path = getPathInFolder(folderPath, filename, folderFd)
+    fileStat = os.stat(path, dir_fd = folderFd)
+    os.utime(path, ns = (fileStat.st_atime_ns, fileStat.st_mtime_ns + timeOffsetInNanoseconds), dir_fd = folderFd)
+
+def getTimeOffsetInNanoseconds(sourceTimeStamp, destinationTimeStamp):
+    '''Get the offset from the source time stamp to the destination time stamp, both in the format of YYYY-MM-DD_HH-MM-SS-TT.
+    Return the offset in nanoseconds, or None if a time stamp is not in the correct format.'''
+    timeStampInNanosecondsList = []
+    for timeStamp in [sourceTimeStamp, destinationTimeStamp]:
+        match = re.match(timeStampPattern, timeStamp)
+        if match is None:
+            return None
+        year, month, day, hour, minute, second, centisecond = (int(group) for group in match.groups())
+        # the whole seconds are counted exactly by timedelta, without the float seconds
+        timeDelta = datetime.datetime(year, month, day, hour, minute, second) - datetime.datetime(1970, 1, 1)
+        timeStampInNanosecondsList.append((timeDelta.days * 86400 + timeDelta.seconds) * 10**9 + centisecond * 10**7)
+    return timeStampInNanosecondsList[1] - timeStampInNanosecondsList[0]
+
+class TimeOffsetTable:
+    '''The time offsets in nanoseconds to correct the wrong clocks of the cameras in one run.
+    An offset is set per camera ID, or per FilenameType (e.g. all the GoPro files), and the default offset is for the other files.
+    The camera ID offset wins over the FilenameType offset.'''
+    def __init__(self, defaultOffset = 0):
+        self.defaultOffset = defaultOffset
+        self.cameraIDOffsetDict = {}
+        self.filenameTypeOffsetDict = {}
+
+    def setCameraIDOffset(self, cameraID, offset):
+        self.cameraIDOffsetDict[cameraID] = offset
+
+    def setFilenameTypeOffset(self, filenameType, offset):
+        self.filenameTypeOffsetDict[filenameType] = offset
+
+    def getOffset(self, filenameType, cameraID):
+        if cameraID in self.cameraIDOffsetDict:
+            return self.cameraIDOffsetDict[cameraID]
+        return self.filenameTypeOffsetDict.get(filenameType, self.defaultOffset)
+
+    def getFileOffset(self, filePath, overrideCameraID = None, defaultCameraID = "Cid"):
+        '''Get the offset of the file, from its camera ID and FilenameType like getFormattedNameFieldsV4.
+        The sidecar files get the offset of their primary files.'''
+        filenameWithoutExtension = os.path.splitext(os.path.basename(filePath))[0]
+        if isSidecarFile(filePath):
+            filenameWithoutExtension = getSidecarPrimaryStemList(filenameWithoutExtension)[0]
+        filenameType, originalFilenameWithoutExtension, cameraID = getOriginalFilenameAndCameraID(filenameWithoutExtension)
+        if overrideCameraID is not None:
+            cameraID = overrideCameraID
+        elif cameraID is None:
+            cameraID = defaultCameraID
+        return self.getOffset(filenameType, cameraID)
+
+def shiftFileTimesInFolder(folderPath, timeOffsetTable, overrideCameraID = None, defaultCameraID = "Cid", maxWorkers = 8, batchSize = 256):
+    '''Shift the modification times of the files in the folder by their offsets in the table.
+    The times are read in nanoseconds from one scandir pass, and the files are changed in parallel batches.
+    Return the number of the files shifted.'''
+    batchList = []
+    batch = []
+    with os.scandir(folderPath) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            offset = timeOffsetTable.getFileOffset(entry.name, overrideCameraID, defaultCameraID)
+            if offset == 0:
+                continue
+            fileStat = entry.stat()
+            batch.append((entry.name, fileStat.st_atime_ns, fileStat.st_mtime_ns + offset))
+            if len(batch) >= batchSize:
+                batchList.append(batch)
+                batch = []
+    if batch:
+        batchList.append(batch)
+
+    with openFolderFd(folderPath) as folderFd:
+        def shiftBatch(batch):
+            shiftedCount = 0
+            for filename, accessTimeInNanoseconds, modifiedTimeInNanoseconds in batch:
+                try:
+                    os.utime(getPathInFolder(folderPath, filename, folderFd), ns = (accessTimeInNanoseconds, modifiedTimeInNanoseconds), 
+                             dir_fd = folderFd)
+                    shiftedCount = shiftedCount + 1
+                except OSError as e:
+                    logger.warning("Error: can not shift the time of " + filename + ": " + str(e))
+            return shiftedCount
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+            return sum(executor.map(shiftBatch, batchList))
+
+def changeFileCreationTimeInFolder(folderPath, sourceTimeStamp, destinationTimeStamp, maxWorkers = 8):
     '''Change the creation date and time of the files in the folder.'''
     # check if the sourceTimeStamp and destinationTimeStamp are in the correct format
     if not validateString(timeStampPattern, sourceTimeStamp):
-        print("The source time stamp is not in the correct format.")
+        logger.warning("The source time stamp is not in the correct format.")
         return
     if not validateString(timeStampPattern, destinationTimeStamp):
-        print("The destination time stamp is not in the correct format.")
+        logger.warning("The destination time stamp is not in the correct format.")
         return
-    # get the time offset in seconds
-    sourceTime = datetime.datetime.strptime(sourceTimeStamp, "%Y-%m-%d_%H-%M-%S-%f")
-    destinationTime = datetime.datetime.strptime(destinationTimeStamp, "%Y-%m-%d_%H-%M-%S-%f")
-
-    timeOffsetInSeconds = (destinationTime - sourceTime).total_seconds()
-    # get the file path list in the folder
-    filePathList = getFilePathList(folderPath)
-    # change the creation time of the files in the folder
-    for filePath in filePathList:
-        chageFileModificationDateAndTime(filePath, timeOffsetInSeconds)
+    # get the time offset in nanoseconds, and shift all the files in the folder by it
+    timeOffsetTable = TimeOffsetTable(getTimeOffsetInNanoseconds(sourceTimeStamp, destinationTimeStamp))
+    return shiftFileTimesInFolder(folderPath, timeOffsetTable, maxWorkers = maxWorkers)
 
     
-def deleteFileByExtension(folderPath, fileExtension):
+def deleteFileInFolder(folderPath, filename, folderFd = None, listenerList = None):
+    # Delete the file in the folder, relative to the folder fd if it is given.
+    logger.info("Deleting " + filename)
+    os.unlink(getPathInFolder(folderPath, filename, folderFd), dir_fd = folderFd)
+    notifyFileDeleted(os.path.join(folderPath, filename), listenerList)
+
+def deleteFileByExtension(folderPath, fileExtension, listenerList = None):
     # Delete all files in the folder with the specified file extension.
     fileNameList = getFilenameListByFileExtension(folderPath, fileExtension)
-    for fileName in fileNameList:
-        print("Deleting " + fileName)
-        os.remove(os.path.join(folderPath, fileName))
+    with openFolderFd(folderPath) as folderFd:
+        for fileName in fileNameList:
+            deleteFileInFolder(folderPath, fileName, folderFd, listenerList)
 
-def deleteTinyFileByExtension(folderPath, fileExtension, fileMinimumSizeinMB = 1):
+def deleteTinyFileByExtension(folderPath, fileExtension, fileMinimumSizeinMB = 1, listenerList = None):
     # Delete all files in the folder with the specified file extension and size.
     fileNameList = getFilenameListByFileExtension(folderPath, fileExtension)
-    for fileName in fileNameList:
-        fileSize = os.path.getsize(os.path.join(folderPath, fileName))
-        if fileSize < fileMinimumSizeinMB * 1024 * 1024:
-            print("Deleting " + fileName)
-            os.remove(os.path.join(folderPath, fileName))
-
-def deleteInvisibleFile(folderPath):
+    with openFolderFd(folderPath) as folderFd:
+        for fileName in fileNameList:
+            filePathInFolder = getPathInFolder(folderPath, fileName, folderFd)
+            fileSize = os.stat(filePathInFolder, dir_fd = folderFd).st_size
+            if fileSize < fileMinimumSizeinMB * 1024 * 1024:
+                deleteFileInFolder(folderPath, fileName, folderFd, listenerList)
+
+def deleteInvisibleFile(folderPath, listenerList = None):
     # Delete all invisible files in the folder    
     # check if the code is running on macOS or Linux
     if os.name == "posix":
         # Invisible files are the files whose name starts with "." in macOS and Linux
-        for filename in os.listdir(folderPath):
-            if filename.startswith("."):
-                print("Deleting " + filename)
-                os.remove(os.path.join(folderPath, filename))
+        with openFolderFd(folderPath) as folderFd:
+            for filename in os.listdir(folderPath):
+                if filename.startswith("."):
+                    deleteFileInFolder(folderPath, filename, folderFd, listenerList)
     # check if the code is running on Windows
     elif os.name == "nt":
         # Invisible files are the files whose attribute is hidden in Windows
         for filename in os.listdir(folderPath):
             if os.path.isfile(os.path.join(folderPath, filename)):
                 if bool(os.stat(os.path.join(folderPath, filename)).st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN):
-                    print("Deleting " + filename)
-                    os.remove(os.path.join(folderPath, filename))
+                    deleteFileInFolder(folderPath, filename, listenerList = listenerList)
     else:
-        print("The operating system is not recognized.")
+        logger.warning("The operating system is not recognized.")
     
 
-def deleteTrashFiles(folderPath):
-    #remove all files with the extension of .THM or .LRV
-    deleteFileByExtension(folderPath, ".THM")
-    deleteFileByExtension(folderPath, ".LRV")
-    deleteTinyFileByExtension(folderPath, ".MP4", 1)
-    deleteInvisibleFile(folderPath)
+def deleteCorruptedMediaFiles(folderPath, maxWorkers = 8, listenerList = None):
+    # Delete the empty and corrupted (e.g. truncated) video and image files in the folder, by sniffing their content.
+    # The files in unknown formats are kept. Return the sniffed results of the kept files.
+    sniffResultDict = sniffFilesInFolder(folderPath, maxWorkers = maxWorkers)
+    deleteCorruptedSniffedFiles(folderPath, sniffResultDict, listenerList = listenerList)
+    return sniffResultDict
+
+def deleteCorruptedSniffedFiles(folderPath, sniffResultDict, folderFd = None, listenerList = None):
+    # Delete the empty and corrupted files of the sniffed results (see sniffFilesInFolder), and drop them from the results.
+    # Return the set of the deleted file paths.
+    deletedFilePathSet = set()
+    for filePath, (fileType, fileContentStatus) in list(sniffResultDict.items()):
+        if fileContentStatus == FileContentStatus.Empty or fileContentStatus == FileContentStatus.Corrupted:
+            logger.debug("The file " + filePath + " is " + fileContentStatus.name.lower() + ".")
+            deleteFileInFolder(folderPath, os.path.basename(filePath), folderFd, listenerList)
+            del sniffResultDict[filePath]
+            deletedFilePathSet.add(filePath)
+    return deletedFilePathSet
+
+def isInvisibleEntry(entry):
+    # check if the file (an os.DirEntry) is invisible: its name starts with "." in macOS and Linux, its attribute is hidden in Windows
+    if os.name == "nt":
+        return bool(entry.stat().st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN)
+    return entry.name.startswith(".")
+
+def getTrashFunction(folderPath, isKeepSidecarFiles = False, folderFd = None, listenerList = None):
+    # Get the function deleting the trash files while the folder is listed, so the folder is listed only once:
+    # the invisible files, and the .THM and .LRV files unless they are kept to be renamed with their primary files.
+    # The function returns True if the file (an os.DirEntry) is deleted.
+    def trashFunction(entry):
+        if not entry.is_file():
+            return False
+        if isInvisibleEntry(entry) or (not isKeepSidecarFiles and isSidecarFile(entry.name)):
+            deleteFileInFolder(folderPath, entry.name, folderFd, listenerList)
+            return True
+        return False
+    return trashFunction
+
+def deleteTrashFiles(folderPath, isKeepSidecarFiles = False, listenerList = None, skipFunction = None, maxWorkers = 8):
+    # Delete the trash files (see getTrashFunction) and the empty and corrupted media files, in one pass over the folder.
+    # The video and image files are judged by their content instead of their size.
+    # The files for which skipFunction(entry) is True (see getFormattedInPlaceSkipFunction) are not sniffed.
+    # Return the sniffed results of the kept files.
+    with openFolderFd(folderPath) as folderFd:
+        trashFunction = getTrashFunction(folderPath, isKeepSidecarFiles, folderFd, listenerList)
+        mediaFilenameList = []
+        with os.scandir(folderPath) as entries:
+            for entry in entries:
+                if trashFunction(entry):
+                    continue
+                if isVideoOrImageFile(entry.name) and (skipFunction is None or not skipFunction(entry)):
+                    mediaFilenameList.append(entry.name)
+        sniffResultDict = sniffFilesInFolder(folderPath, mediaFilenameList, maxWorkers)
+        deleteCorruptedSniffedFiles(folderPath, sniffResultDict, folderFd, listenerList)
+    return sniffResultDict
 
 # ==================== Functions to rename the file ====================
 def checkFilenameType(filenameWithoutExtension):
     '''check the filename type, return the filename type'''
-    if DEBUG:
-        print("Checking the filename type of " + filenameWithoutExtension + ".")
+    logger.debug("Checking the filename type of " + filenameWithoutExtension + ".")
     for filenameType in FilenameType:
         if filenameType != FilenameType.Unknown:
         # check if the filename matches the pattern
@@ -542,29 +1145,70 @@ def checkFilenameType(filenameWithoutExtension):
                 return filenameType
     return FilenameType.Unknown
 
-def getFormattedNameV4(filePath, destinationFolderPath = None, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False):
-    '''Rename the file to the formatted name in the format of YYYYMMDD_HHMMSSTT_IIIII(?:_NN)-OriginalFilename'''
-    # get the file information
-    filename = os.path.basename(filePath)
-    filenameWithoutExtension, fileExtension = os.path.splitext(filename)
+# st_ctime is the creation time on Windows only. On Linux and macOS it is the change time, which every rename updates,
+# so the files named by it never keep the time in their names, and can not be told as formatted in place.
+isCreationTimeStable = os.name == "nt"
+
+def isFormattedInPlace(entry, overrideCameraID = None, isUseModifiedTime = False, fileType = None):
+    '''The fast path of the re-runs: check if the file (an os.DirEntry) already has the FormattedV4 name it would get in its folder,
+    by comparing the parsed name fields with the stat of the entry (cached by os.scandir on Windows, one stat call on Linux and macOS).
+    It only applies to the files named by a stable time: the videos with isUseModifiedTime, and the others on Windows only,
+    see isCreationTimeStable. Return False when in doubt, the file then goes through the full planning of getFormattedNameV4.'''
+    match = re.match(FilenamePattern[FilenameType.FormattedV4], os.path.splitext(entry.name)[0])
+    if match is None:
+        return False
+    if overrideCameraID is not None and match.group(8) != overrideCameraID:
+        return False
+    fileType = getFileType(entry.name) if fileType is None or fileType == FileType.Unknown else fileType
+    try:
+        if fileType == FileType.Video and isUseModifiedTime:
+            timeBySeconds = entry.stat().st_mtime
+        elif (fileType == FileType.Video or fileType == FileType.Image) and isCreationTimeStable:
+            timeBySeconds = entry.stat().st_ctime
+        else:
+            return False
+    except OSError:
+        return False
+    capturedDate, capturedTime = formatDateAndTime(timeBySeconds)
+    return "".join(match.group(1, 2, 3)) == capturedDate and "".join(match.group(4, 5, 6, 7)) == capturedTime
+
+def getFormattedInPlaceSkipFunction(sourceFolder, destinationFolder = None, overrideCameraID = None, isUseModifiedTime = False,
+                                    layout = DestinationLayout.Flat, sniffResultDict = None, timeOffsetTable = None):
+    '''Get the function telling the files which can be skipped while listing the source folder (see isFormattedInPlace).
+    Return None if the files are moved, to another folder or into the sub folders, or their times are shifted,
+    and every file has to be planned.'''
+    if (destinationFolder is not None and os.path.abspath(destinationFolder) != os.path.abspath(sourceFolder)) \
+        or layout != DestinationLayout.Flat or timeOffsetTable is not None:
+        return None
+    def skipFunction(entry):
+        if isFormattedInPlace(entry, overrideCameraID, isUseModifiedTime, None if sniffResultDict is None 
+                              else sniffResultDict.get(entry.path, (FileType.Unknown, FileContentStatus.Unknown))[0]):
+            logger.debug("The file " + entry.path + " is already formatted, skipped.")
+            return True
+        return False
+    return skipFunction
+
+def getFormattedNameV4(filePath, destinationFolderPath = None, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False, 
+                       destinationFolderFd = None, layout = DestinationLayout.Flat, destinationFolderIndex = None, fileType = None,
+                       timeOffsetInNanoseconds = 0):
+    '''Rename the file to the formatted name in the format of YYYYMMDD_HHMMSSTT_IIIII(?:_NN)-OriginalFilename
+    If the destination folder is already opened, the name collisions are checked relative to destinationFolderFd.
+    For the layouts other than flat, the returned name is prefixed with the sub folder, like 2023/07/formattedName.
+    If destinationFolderIndex is given, the name collisions are checked (per sub folder) in the index,
+    and the returned name is reserved in the index.
+    fileType is the sniffed FileType of the file, if it is not given, the file type is told by the extension.
+    The captured date and time in the name are shifted by timeOffsetInNanoseconds.'''
     destinationFolderPath = os.path.dirname(filePath) if destinationFolderPath is None else destinationFolderPath
+    formattedNameFields = getFormattedNameFieldsV4(filePath, overrideCameraID, defaultCameraID, isUseModifiedTime, layout, fileType,
+                                                   timeOffsetInNanoseconds)
+    if formattedNameFields is None:
+        return None
+    return reserveFormattedNameV4(filePath, formattedNameFields, destinationFolderPath, destinationFolderFd, destinationFolderIndex)
 
-    capturedDate = None
-    capturedTime = None
+def getOriginalFilenameAndCameraID(filenameWithoutExtension):
+    '''Get the filename type, the original filename (without extension) and the camera ID from the filename.
+    The camera ID is None if it is not in the filename.'''
     cameraID = None
-    uniqueID = 1
-    originalFilenameWithoutExtension = None
-
-    # get the captured date and time
-    if isVideoFile(filePath):
-        capturedDate, capturedTime = getVideoCapturedDateAndTime(filePath, isUseModifiedTime)
-    elif isImageFile(filePath):
-        capturedDate, capturedTime = getCreationDateAndTime(filePath)
-    else:
-        if DEBUG:
-            print("The file is not a video or image file.")
-        return None
-    
     # get the filename type
     filenameType = checkFilenameType(filenameWithoutExtension)
     if filenameType == FilenameType.FormattedV1:
@@ -585,6 +1229,32 @@ def getFormattedNameV4(filePath, destinationFolderPath = None, overrideCameraID
     else:
         # in this case, the original filename is the same with the filename without extension cause it is not formatted yet.
         originalFilenameWithoutExtension = filenameWithoutExtension
+    return filenameType, originalFilenameWithoutExtension, cameraID
+
+def getFormattedNameFieldsV4(filePath, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False,
+                             layout = DestinationLayout.Flat, fileType = None, timeOffsetInNanoseconds = 0):
+    '''Get the fields of the formatted name of the file, without checking the name collisions.
+    The captured date and time are shifted by the time offset (see TimeOffsetTable).
+    Return a tuple of (capturedDate, capturedTime, cameraID, originalFilenameWithoutExtension, fileExtension, subFolder),
+    or None if the file is not a video or image file.'''
+    # get the file information
+    filename = os.path.basename(filePath)
+    filenameWithoutExtension, fileExtension = os.path.splitext(filename)
+
+    capturedDate = None
+    capturedTime = None
+
+    # get the captured date and time
+    fileType = getFileType(filePath) if fileType is None or fileType == FileType.Unknown else fileType
+    if fileType == FileType.Video:
+        capturedDate, capturedTime = getVideoCapturedDateAndTime(filePath, isUseModifiedTime, timeOffsetInNanoseconds)
+    elif fileType == FileType.Image:
+        capturedDate, capturedTime = getCreationDateAndTime(filePath, timeOffsetInNanoseconds)
+    else:
+        logger.debug("The file is not a video or image file.")
+        return None
+    
+    filenameType, originalFilenameWithoutExtension, cameraID = getOriginalFilenameAndCameraID(filenameWithoutExtension)
     
     # get the camera ID. If overrideCameraID is None, use the camera ID in the filename.
     # Potentially, we can try to figure out the camera ID from the file metadata.
@@ -597,16 +1267,28 @@ def getFormattedNameV4(filePath, destinationFolderPath = None, overrideCameraID
     else:
         cameraID = overrideCameraID
     
+    # get the sub folder of the file in the destination folder
+    subFolder = getLayoutSubFolder(capturedDate, cameraID, layout)
+    return capturedDate, capturedTime, cameraID, originalFilenameWithoutExtension, fileExtension, subFolder
+
+def reserveFormattedNameV4(filePath, formattedNameFields, destinationFolderPath, destinationFolderFd = None, destinationFolderIndex = None):
+    '''Get a free formatted name from the fields (see getFormattedNameFieldsV4), adding the unique ID _NN on collisions.
+    Return the name prefixed with the sub folder, or None if the file is already there or there is no free unique ID.'''
+    capturedDate, capturedTime, cameraID, originalFilenameWithoutExtension, fileExtension, subFolder = formattedNameFields
+    uniqueID = 1
     # get the potential formatted filename
     potentialFormattedFilename = capturedDate + "_" + capturedTime + "_" + cameraID \
         + "-" + originalFilenameWithoutExtension + fileExtension
 
-    # check if the potential formatted filename has a file with the same name in the destination folder
-    while os.path.isfile(os.path.join(destinationFolderPath, potentialFormattedFilename)):
+    # check if the potential formatted filename has a file with the same name in the destination (sub) folder
+    while isFormattedFilenameTaken(subFolder, potentialFormattedFilename, destinationFolderPath, destinationFolderFd, destinationFolderIndex):
         # check if the file in the destination folder is the same with the file in the source folder
-        if os.path.samefile(filePath, os.path.join(destinationFolderPath, potentialFormattedFilename)):
-            if DEBUG:
-                print("The file is the same with the file in the destination folder.")
+        if destinationFolderIndex is not None:
+            isSameFile = destinationFolderIndex.isSameFile(filePath, subFolder, potentialFormattedFilename, destinationFolderFd)
+        else:
+            isSameFile = isSameFileInFolder(filePath, destinationFolderPath, os.path.join(subFolder, potentialFormattedFilename), destinationFolderFd)
+        if isSameFile:
+            logger.debug("The file is the same with the file in the destination folder.")
             return None
         else:
             # if there is a file with the same name, increase the unique ID by 1
@@ -617,10 +1299,21 @@ def getFormattedNameV4(filePath, destinationFolderPath = None, overrideCameraID
                 potentialFormattedFilename = capturedDate + "_" + capturedTime + "_" + cameraID \
                     + "_" + str(uniqueID).zfill(2) + "-" + originalFilenameWithoutExtension + fileExtension
             else:
-                if DEBUG:
-                    print("The unique ID is not an integer larger than 1 and smaller than 100.")
+                logger.debug("The unique ID is not an integer larger than 1 and smaller than 100.")
                 return None
-    return potentialFormattedFilename
+    return os.path.join(subFolder, potentialFormattedFilename)
+
+def hasUniqueIDSuffix(filename):
+    '''check if the FormattedV4 filename has the unique ID _NN, which is added on the name collisions'''
+    match = re.match(FilenamePattern[FilenameType.FormattedV4], os.path.splitext(os.path.basename(filename))[0])
+    return match is not None and match.group(9) is not None
+
+def isFormattedFilenameTaken(subFolder, filename, destinationFolderPath, destinationFolderFd = None, destinationFolderIndex = None):
+    '''check if the filename is taken in the sub folder of the destination folder.
+    With destinationFolderIndex, the check is done in memory and a free filename is reserved at once.'''
+    if destinationFolderIndex is not None:
+        return not destinationFolderIndex.reserveFilename(subFolder, filename)
+    return isFileInFolder(destinationFolderPath, os.path.join(subFolder, filename), destinationFolderFd)
 
 
 def getOriginalFilenameFromFormattedV1(filenameWithoutExtension):
@@ -632,8 +1325,7 @@ def getOriginalFilenameFromFormattedV1(filenameWithoutExtension):
         date, cameraID, sequenceNumber, chapterNumber, time, codex = filenameWithoutExtension.split("_")
         return codex+chapterNumber+sequenceNumber, cameraID
     else:
-        if DEBUG:
-            print("The filename (without extension) " + filenameWithoutExtension + " is not in the format of FormattedV1.")
+        logger.debug("The filename (without extension) " + filenameWithoutExtension + " is not in the format of FormattedV1.")
         return None, None
     
 def getOriginalFilenameFromFormattedV2(filenameWithoutExtension):
@@ -653,13 +1345,11 @@ def getOriginalFilenameFromFormattedV2(filenameWithoutExtension):
         elif cameraAndDataType == "CI" and codex == "DSCF":
             originalFilenameWithoutExtension = "DSCF" + sequenceNumber
         else: # unknown camera and data type
-            if DEBUG:
-                print("The camera and data type is unknown.")
+            logger.debug("The camera and data type is unknown.")
             return None
         return originalFilenameWithoutExtension, cameraID
     else:
-        if DEBUG:
-            print("The filename is not in the format of FormattedV2.")
+        logger.debug("The filename is not in the format of FormattedV2.")
         return None, None
 
 def getOriginalFilenameFromFormattedV3(filenameWithoutExtension):
@@ -668,11 +1358,11 @@ def getOriginalFilenameFromFormattedV3(filenameWithoutExtension):
     if checkFilenameType(filenameWithoutExtension) == FilenameType.FormattedV3:
         originalFilenameWithoutExtension = filenameWithoutExtension.split("(")[1]
         originalFilenameWithoutExtension = originalFilenameWithoutExtension.split(")")[0]
-        cameraID = filenameWithoutExtension.split("_")[2]
+        # the camera ID is the 8th group of the pattern, the original filename might contain "_" as well
+        cameraID = re.match(FilenamePattern[FilenameType.FormattedV3], filenameWithoutExtension).group(8)
         return originalFilenameWithoutExtension, cameraID
     else:
-        if DEBUG:
-            print("The filename is not in the format of FormattedV3.")
+        logger.debug("The filename is not in the format of FormattedV3.")
         return None, None
 
 def getOriginalFilenameFromFormattedV3FromGoproMediaLib(filenameWithoutExtension):
@@ -697,15 +1387,15 @@ def getOriginalFilenameFromFormattedV3FromGoproMediaLib(filenameWithoutExtension
             originalFilenameWithoutExtension = originalFilenameWithoutExtension[:-2]
         return originalFilenameWithoutExtension, cameraID
     else:
-        if DEBUG:
-            print("The filename is not in the format of V3FromGoproMediaLib.")
+        logger.debug("The filename is not in the format of V3FromGoproMediaLib.")
         return None, None
 
 def getOriginalFilenameFromFormattedV4(filenameWithoutExtension):
     '''Get the original filename from the formatted name in the format of YYYYMMDD_HHMMSSTT_IIIII(_NN)?-OriginalFilenameWithoutExtension'''
     # get the file information
     if checkFilenameType(filenameWithoutExtension) == FilenameType.FormattedV4:
-        cameraID = filenameWithoutExtension.split("_")[2]
+        # the camera ID is the 8th group of the pattern, the original filename might contain "_" as well
+        cameraID = re.match(FilenamePattern[FilenameType.FormattedV4], filenameWithoutExtension).group(8)
         originalFilenameWithoutExtension = ""
 
         filenameRoughElements = filenameWithoutExtension.split("-")
@@ -721,110 +1411,279 @@ def getOriginalFilenameFromFormattedV4(filenameWithoutExtension):
             originalFilenameWithoutExtension = filenameRoughElements[1]
         else: # len(filenameRoughElements) == 1 or 0
             # in this case, the filename does not contain "-", which means it is not formatted as formattedV4
-            if DEBUG:
-                print("The filename is not in the format of FormattedV4.")
+            logger.debug("The filename is not in the format of FormattedV4.")
             return None, None
         return originalFilenameWithoutExtension, cameraID
     else:
-        if DEBUG:
-            print("The filename is not in the format of FormattedV4.")
+        logger.debug("The filename is not in the format of FormattedV4.")
         return None, None
 
-def renameFile(filePath, newFilename, destinationFolderPath = None):
-    '''Rename the file to the new filename.'''
-    destinationFolderPath = os.path.dirname(filePath) if destinationFolderPath is None else destinationFolderPath
-    # check if the file exists
-    if not os.path.isfile(filePath):
-        if DEBUG:
-            print("The file " + filePath + " does not exist.")
-        return False
-    # check if the new filename exists in the destination folder
-    if os.path.isfile(os.path.join(destinationFolderPath, newFilename)):
-        if DEBUG:
-            print("The file " + newFilename + " already exists in the destination folder " + destinationFolderPath + ".")
-        return False
-    # rename the file
+def renameFile(filePath, newFilename, destinationFolderPath = None, sourceFolderFd = None, destinationFolderFd = None, destinationBackend = None,
+               listenerList = None):
+    '''Rename the file to the new filename.
+    If the source and destination folders are already opened, the rename is done relative to their fds.
+    The file is moved through destinationBackend, e.g. uploaded to a bucket (see DestinationBackend.py),
+    or through the LocalDestinationBackend of the destination folder if it is not given.
+    The listeners of listenerList are notified of the rename, see fileOperationListenerList.
+    Return True if the file is renamed, the error is logged otherwise.'''
     try:
-        os.rename(filePath, os.path.join(destinationFolderPath, newFilename))
-        return True
+        return moveFileToNewName(filePath, newFilename, destinationFolderPath, sourceFolderFd, destinationFolderFd, destinationBackend, listenerList)
     except Exception as e:
-        if DEBUG:
-            print("Error: " + e)
+        logRenameError(filePath, newFilename, e)
         return False
 
-def renameMediaFilesInFolder(sourceFolder, destinationFolder = None, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False):
-    '''Process all the files in the folder'''
-    destinationFolder = sourceFolder if destinationFolder is None else destinationFolder
-    # get the file path list
-    filePathList = getFilePathList(sourceFolder)
-    # rename the files
-    for filePath in filePathList:
-        newFilename = None
+def moveFileToNewName(filePath, newFilename, destinationFolderPath = None, sourceFolderFd = None, destinationFolderFd = None,
+                      destinationBackend = None, listenerList = None):
+    '''Rename the file like renameFile, but raise the error of the move, e.g. to tell a timeout from a name collision.
+    Return False if the file does not exist.'''
+    sourceFolderPath, filename = os.path.split(filePath)
+    destinationFolderPath = sourceFolderPath if destinationFolderPath is None else destinationFolderPath
+    if destinationBackend is None:
+        destinationBackend = LocalDestinationBackend(destinationFolderPath)
+    # check if the file exists
+    if not isFileInFolder(sourceFolderPath, filename, sourceFolderFd):
+        logger.debug("The file " + filePath + " does not exist.")
+        return False
+    # rename the file, move it if the destination folder is on another device, or upload it
+    newLocation = destinationBackend.moveFile(sourceFolderPath, filename, newFilename, sourceFolderFd, destinationFolderFd, listenerList)
+    notifyFileRenamed(filePath, newLocation, listenerList)
+    return True
+
+def logRenameError(filePath, newFilename, error):
+    '''Log the error of a failed rename, the name collisions are only logged in the details'''
+    if isinstance(error, FileExistsError):
+        logger.debug(str(error))
+    else:
+        logger.warning("Error: can not move " + filePath + " to " + newFilename + ": " + str(error))
+
+class RenameOperation:
+    '''One operation of the rename plan: a file, its new name in the destination folder, 
+    and the sidecar files which are renamed or moved together with it.'''
+    def __init__(self, sourceFolderPath, filename, destinationFolderPath, newFilename, sidecarRenameList = None, timeOffsetInNanoseconds = 0):
+        self.sourceFolderPath = sourceFolderPath
+        self.filename = filename
+        self.destinationFolderPath = destinationFolderPath
+        self.newFilename = newFilename
+        # list of (sidecarFilename, newSidecarFilename)
+        self.sidecarRenameList = [] if sidecarRenameList is None else sidecarRenameList
+        # the time shift folded into the plan, the modification times are shifted just before the renaming
+        self.timeOffsetInNanoseconds = timeOffsetInNanoseconds
+        # the error of the last failed move of the file or its sidecar files, set by executeRenameOperation
+        self.error = None
+
+    def getFilePath(self):
+        return os.path.join(self.sourceFolderPath, self.filename)
+
+def planRenameMediaFile(filePath, destinationFolder, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False,
+                        destinationFolderFd = None, layout = DestinationLayout.Flat, destinationFolderIndex = None, sidecarFilenameList = None,
+                        fileType = None, timeOffsetTable = None):
+    '''Plan the renaming of a single media file (and its sidecar files, see SidecarIndex). Return a RenameOperation, or None if nothing to do.
+    fileType is the sniffed FileType of the file, if it is not given, the file type is told by the extension.
+    With timeOffsetTable, the time shift of the file is folded into the plan: the new name uses the shifted time,
+    and the modification time is shifted when the operation is executed.'''
+    newFilename = None
+    timeOffsetInNanoseconds = 0 if timeOffsetTable is None else timeOffsetTable.getFileOffset(filePath, overrideCameraID, defaultCameraID)
+    try:
+        newFilename = getFormattedNameV4(filePath, destinationFolder, overrideCameraID, defaultCameraID, isUseModifiedTime, destinationFolderFd,
+                                         layout, destinationFolderIndex, fileType, timeOffsetInNanoseconds)
+    except Exception as e:
+        logger.debug("Error: " + str(e))
+        return None
+    if newFilename is None:
+        logger.debug("The file " + filePath + " is not renamed or moved.")
+        return None
+    return createRenameOperation(filePath, destinationFolder, newFilename, destinationFolderIndex, sidecarFilenameList, timeOffsetInNanoseconds)
+
+def createRenameOperation(filePath, destinationFolder, newFilename, destinationFolderIndex = None, sidecarFilenameList = None,
+                          timeOffsetInNanoseconds = 0):
+    '''Create the RenameOperation of the file to its reserved new name, and reserve the new names of its sidecar files.'''
+    sourceFolder, filename = os.path.split(filePath)
+    sidecarRenameList = []
+    if sidecarFilenameList:
+        subFolder, newFilenameInSubFolder = os.path.split(newFilename)
+        for sidecarFilename in sidecarFilenameList:
+            newSidecarFilename = getSidecarFormattedFilename(newFilenameInSubFolder, sidecarFilename)
+            if destinationFolderIndex is None or destinationFolderIndex.reserveFilename(subFolder, newSidecarFilename):
+                sidecarRenameList.append((sidecarFilename, os.path.join(subFolder, newSidecarFilename)))
+    return RenameOperation(sourceFolder, filename, destinationFolder, newFilename, sidecarRenameList, timeOffsetInNanoseconds)
+
+def executeRenameOperation(renameOperation, sourceFolderFd = None, destinationFolderFd = None, destinationFolderIndex = None,
+                           destinationBackend = None, listenerList = None):
+    '''Rename the file of the operation, and then its sidecar files. Return True if the file is renamed.
+    If destinationBackend is given, the files are moved through it (see renameFile).
+    The error of a failed move is kept in renameOperation.error.'''
+    op = renameOperation
+
+    def renameShiftedFile(filename, newFilename):
+        '''Rename the file, with the time shift folded into the plan. The time is shifted before the file is moved,
+        so every backend keeps the shifted time, and it is shifted back if the file is not moved, so a re-run does not shift it twice.'''
+        isShifted = False
+        if op.timeOffsetInNanoseconds != 0:
+            try:
+                shiftFileTimeInFolder(op.sourceFolderPath, filename, op.timeOffsetInNanoseconds, sourceFolderFd)
+                isShifted = True
+            except OSError as e:
+                logger.warning("Error: can not shift the time of " + filename + ": " + str(e))
+        filePath = os.path.join(op.sourceFolderPath, filename)
         try:
-            newFilename = getFormattedNameV4(filePath, destinationFolder, overrideCameraID, defaultCameraID, isUseModifiedTime)
+            isRenamed = moveFileToNewName(filePath, newFilename, op.destinationFolderPath, sourceFolderFd, destinationFolderFd,
+                                          destinationBackend, listenerList)
         except Exception as e:
-            if DEBUG:
-                print("Error: " + e)
-            continue
-        if newFilename is not None:
-            renameFile(filePath, newFilename, destinationFolder)
-            
-            if DEBUG:
-                outputString = "The file " + filePath
-                if newFilename != os.path.basename(filePath):
-                    outputString += " is renamed to " + newFilename
-                else:
-                    outputString += " has the same formatted name"
-
-                if destinationFolder == sourceFolder:
-                    outputString += "."
-                else:
-                    outputString += ", and moved to " + destinationFolder + "."
-                print(outputString)
+            logRenameError(filePath, newFilename, e)
+            op.error = e
+            isRenamed = False
+        if isShifted and not isRenamed:
+            try:
+                shiftFileTimeInFolder(op.sourceFolderPath, filename, -op.timeOffsetInNanoseconds, sourceFolderFd)
+            except OSError as e:
+                logger.warning("Error: can not shift back the time of " + filename + ": " + str(e))
+        return isRenamed
+
+    if not renameShiftedFile(op.filename, op.newFilename):
+        return False
+    releasedFilenameList = [op.filename]
+    for sidecarFilename, newSidecarFilename in op.sidecarRenameList:
+        if renameShiftedFile(sidecarFilename, newSidecarFilename):
+            releasedFilenameList.append(sidecarFilename)
+    # the old names in the flat destination folder are free again
+    if destinationFolderIndex is not None and op.sourceFolderPath == op.destinationFolderPath:
+        for releasedFilename in releasedFilenameList:
+            destinationFolderIndex.releaseFilename("", releasedFilename)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        outputString = "The file " + op.getFilePath()
+        if op.newFilename != op.filename:
+            outputString += " is renamed to " + op.newFilename
         else:
-            if DEBUG:
-                print("The file " + filePath + " is not renamed or moved.")
-            continue
+            outputString += " has the same formatted name"
+        if op.sidecarRenameList:
+            outputString += " (with " + ", ".join(sidecarFilename for sidecarFilename, _ in op.sidecarRenameList) + ")"
 
-def restoreOriginalFilenamesInFolder(sourceFolder, destinationFolder = None):
-    '''Process all the files in the folder'''
+        if op.destinationFolderPath == op.sourceFolderPath:
+            outputString += "."
+        else:
+            outputString += ", and moved to " + op.destinationFolderPath + "."
+        logger.debug(outputString)
+    return True
+
+def renameMediaFilesInFolder(sourceFolder, destinationFolder = None, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False,
+                             layout = DestinationLayout.Flat, sniffResultDict = None):
+    '''Process all the files in the folder.
+    The sidecar files left in the folder (.THM, .LRV) are renamed or moved together with their primary files.
+    sniffResultDict is the sniffed content of the files (see deleteTrashFiles), used to tell videos from images.'''
     destinationFolder = sourceFolder if destinationFolder is None else destinationFolder
-    # get the file path list
-    filePathList = getFilePathList(sourceFolder)
-    # rename the files
-    for filePath in filePathList:
-        filenameWithoutExtension, fileExtension = os.path.splitext(os.path.basename(filePath))
-        filenameType = checkFilenameType(filenameWithoutExtension)
-
-        if filenameType == FilenameType.FormattedV1:
-            newFilename = getOriginalFilenameFromFormattedV1(filenameWithoutExtension)[0] + fileExtension
-        elif filenameType == FilenameType.FormattedV2:
-            newFilename = getOriginalFilenameFromFormattedV2(filenameWithoutExtension)[0] + fileExtension
-        elif filenameType == FilenameType.FormattedV3:
-            newFilename = getOriginalFilenameFromFormattedV3(filenameWithoutExtension)[0] + fileExtension
-        elif filenameType == FilenameType.V3FromGoproMediaLib:
-            newFilename = getOriginalFilenameFromFormattedV3FromGoproMediaLib(filenameWithoutExtension)[0] + fileExtension
-        elif filenameType == FilenameType.FormattedV4:
-            newFilename = getOriginalFilenameFromFormattedV4(filenameWithoutExtension)[0] + fileExtension
-
-        elif filenameType == FilenameType.Unknown:
-            print("The filename " + os.path.basename(filePath) + " is not recognized.")
-            continue
+    # get the file path list and pair the sidecar files in the same pass
+    sidecarIndex = SidecarIndex()
+    skipFunction = getFormattedInPlaceSkipFunction(sourceFolder, destinationFolder, overrideCameraID, isUseModifiedTime, layout, sniffResultDict)
+    filePathList = [os.path.join(sourceFolder, filename) for filename in sidecarIndex.addFolder(sourceFolder, skipFunction)]
+    os.makedirs(destinationFolder, exist_ok = True)
+    # the destination sub folders are created and listed lazily, once per sub folder
+    destinationFolderIndex = DestinationFolderIndex(destinationFolder)
+    # open the source and destination folders once, and rename the files relative to them
+    with openFolderFd(sourceFolder) as sourceFolderFd, openFolderFd(destinationFolder) as destinationFolderFd:
+        for filePath in filePathList:
+            renameOperation = planRenameMediaFile(filePath, destinationFolder, overrideCameraID, defaultCameraID, isUseModifiedTime,
+                                                  destinationFolderFd, layout, destinationFolderIndex, 
+                                                  sidecarIndex.getSidecarFilenameList(sourceFolder, os.path.basename(filePath)), getFileType(filePath, sniffResultDict))
+            if renameOperation is not None:
+                executeRenameOperation(renameOperation, sourceFolderFd, destinationFolderFd, destinationFolderIndex)
+
+def getRestoredFilename(filename):
+    '''Get the original filename (with extension) and the camera ID of a formatted file.
+    Return None, None if the filename is not formatted or the original filename is unknown.'''
+    filenameWithoutExtension, fileExtension = os.path.splitext(filename)
+    filenameType = checkFilenameType(filenameWithoutExtension)
+    getOriginalFilenameFunction = {
+        FilenameType.FormattedV1: getOriginalFilenameFromFormattedV1,
+        FilenameType.FormattedV2: getOriginalFilenameFromFormattedV2,
+        FilenameType.FormattedV3: getOriginalFilenameFromFormattedV3,
+        FilenameType.V3FromGoproMediaLib: getOriginalFilenameFromFormattedV3FromGoproMediaLib,
+        FilenameType.FormattedV4: getOriginalFilenameFromFormattedV4,
+    }.get(filenameType)
+    if getOriginalFilenameFunction is None:
+        if filenameType == FilenameType.Unknown:
+            logger.info("The filename " + filename + " is not recognized.")
         else: # the filename is not formatted
-            print("The filename " + os.path.basename(filePath) + " is not formatted, \n but it is recognized as a " + str(filenameType) + " file.")
+            logger.info("The filename " + filename + " is not formatted, \n but it is recognized as a " + str(filenameType) + " file.")
+        return None, None
+    result = getOriginalFilenameFunction(filenameWithoutExtension)
+    if result is None or result[0] is None:
+        return None, None
+    originalFilenameWithoutExtension, cameraID = result
+    return getSidecarOriginalFilename(originalFilenameWithoutExtension + fileExtension), cameraID
+
+def planRestoreOriginalFilenames(sourceFolder, destinationFolder, destinationFolderIndex, conflictPolicy = RestoreConflictPolicy.Suffix):
+    '''Plan the restoring of the original filenames of the files in the folder.
+    The files are planned in the order of their (formatted) names, so the earliest file keeps the original name,
+    and the later ones with the same original name are handled by the conflict policy.
+    Return the list of RenameOperation, the list of (filename, reason) which can not be restored,
+    and the list of the filenames skipped because they were never formatted (e.g. notes.txt).'''
+    renameOperationList = []
+    failedList = []
+    skippedFilenameList = []
+    with os.scandir(sourceFolder) as entries:
+        filenameList = sorted(entry.name for entry in entries if entry.is_file())
+    for filename in filenameList:
+        restoredFilename, cameraID = getRestoredFilename(filename)
+        if restoredFilename is None:
+            # nothing to restore, it is not a failure
+            skippedFilenameList.append(filename)
             continue
-            
-        if newFilename is not None:
-            renameFile(filePath, newFilename, destinationFolder)
-            if DEBUG:
+        subFolder = ""
+        newFilename = restoredFilename
+        if not destinationFolderIndex.reserveFilename(subFolder, newFilename):
+            # the original filename is taken, by another restored file or by a file in the destination folder
+            if conflictPolicy == RestoreConflictPolicy.Skip:
+                failedList.append((filename, "the original filename " + restoredFilename + " is taken"))
+                continue
+            elif conflictPolicy == RestoreConflictPolicy.CameraSubFolder:
+                subFolder = cameraID
+            newFilename = reserveMergedFilename(destinationFolderIndex, restoredFilename, subFolder)
+        renameOperationList.append(RenameOperation(sourceFolder, filename, destinationFolder, os.path.join(subFolder, newFilename)))
+    return renameOperationList, failedList, skippedFilenameList
+
+def restoreOriginalFilenamesInFolder(sourceFolder, destinationFolder = None, conflictPolicy = RestoreConflictPolicy.Suffix, maxWorkers = 8,
+                                     listenerList = None):
+    '''Restore the original filenames of the files in the folder. 
+    The renames are planned first, and then executed in parallel.
+    Return the list of (filename, reason) which can not be restored. The files which were never formatted are skipped, not failed.'''
+    destinationFolder = sourceFolder if destinationFolder is None else destinationFolder
+    os.makedirs(destinationFolder, exist_ok = True)
+    destinationFolderIndex = DestinationFolderIndex(destinationFolder)
+    renameOperationList, failedList, skippedFilenameList = planRestoreOriginalFilenames(sourceFolder, destinationFolder,
+                                                                                        destinationFolderIndex, conflictPolicy)
+    fileCount = len(renameOperationList) + len(failedList)
+
+    # rename the files, relative to the opened source and destination folders
+    with openFolderFd(sourceFolder) as sourceFolderFd, openFolderFd(destinationFolder) as destinationFolderFd:
+        def restoreFile(renameOperation):
+            isRenamed = renameFile(renameOperation.getFilePath(), renameOperation.newFilename, destinationFolder, sourceFolderFd, destinationFolderFd,
+                                   listenerList = listenerList)
+            if isRenamed and logger.isEnabledFor(logging.DEBUG):
                 if destinationFolder == sourceFolder:
-                    print("The file " + filePath + " is renamed to " + newFilename + ".")
+                    logger.debug("The file " + renameOperation.getFilePath() + " is renamed to " + renameOperation.newFilename + ".")
                 else:
-                    print("The file " + filePath + " is renamed to " + newFilename + " and moved to " + destinationFolder + ".")
-        else:
-            if DEBUG:
-                print("The file " + filePath + " is not renamed.")
-            continue
+                    logger.debug("The file " + renameOperation.getFilePath() + " is renamed to " + renameOperation.newFilename + " and moved to " + destinationFolder + ".")
+            return isRenamed
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers) as executor:
+            isRenamedList = list(executor.map(restoreFile, renameOperationList))
+
+    for renameOperation, isRenamed in zip(renameOperationList, isRenamedList):
+        if not isRenamed:
+            failedList.append((renameOperation.filename, "failed to rename to " + renameOperation.newFilename))
+    logRestoreSummary(fileCount, failedList, len(skippedFilenameList))
+    return failedList
+
+def logRestoreSummary(fileCount, failedList, skippedCount = 0):
+    '''Log how many files are restored, and the files which could not be restored.'''
+    logger.info(str(fileCount - len(failedList)) + " of " + str(fileCount) + " files are restored to the original filenames.")
+    if skippedCount > 0:
+        logger.info(str(skippedCount) + " files are skipped, they were never formatted.")
+    if len(failedList) > 0:
+        logger.warning("The files could not be restored:")
+        for filename, reason in failedList:
+            logger.warning("  " + filename + ": " + reason)
 
 def checkFilesInFolder(folderPath, printDetailedList = False):
     '''check the files in the folder, print the detailed list if printDetailedList is True'''
@@ -0,0 +1,224 @@
+# In this file, the files from several source folders (card readers) are renamed
+# into one destination folder at the same time.
+
+# The work is grouped by the device (st_dev) of the source folders.
+# Each device gets its own few worker threads, so the card readers do not slow each other down,
+# and the operations writing to the destination device are limited by one global cap.
+# All the source folders share one destination filename index, so there is no name collision between them.
+
+import os
+import os.path
+import errno
+import threading
+import contextlib
+import queue
+import time
+import logging
+
+from FileUtility import *
+
+logger = logging.getLogger(__name__)
+
+# the errors of an overloaded destination. The other errors (a name collision, a permission error, ...) say nothing about its latency.
+congestionErrnoSet = {errno.EIO, errno.ETIMEDOUT, errno.EAGAIN, errno.EBUSY, errno.ENOBUFS}
+
+def isCongestionError(error):
+    '''check if the error of an operation is a timeout or an I/O error of the destination'''
+    return isinstance(error, TimeoutError) or (isinstance(error, OSError) and error.errno in congestionErrnoSet)
+
+class AdaptiveConcurrencyController:
+    '''Limit the in-flight operations, and adapt the limit to the observed latency and errors (AIMD).
+    The limit grows by about one per round of operations while the latency stays close to the fastest latency seen,
+    and shrinks multiplicatively when the latency goes up (e.g. an overloaded NAS) or an operation times out (see isCongestionError).'''
+    def __init__(self, maximumConcurrency = 8, minimumConcurrency = 1, initialConcurrency = None, latencyTolerance = 2.0,
+                 decreaseFactor = 0.7, errorDecreaseFactor = 0.5, latencyFloor = 0.01):
+        self.maximumConcurrency = maximumConcurrency
+        self.minimumConcurrency = minimumConcurrency
+        self.concurrency = float(minimumConcurrency if initialConcurrency is None else initialConcurrency)
+        # the latency higher than the fastest latency times the tolerance means the target is overloaded
+        self.latencyTolerance = latencyTolerance
+        # the latency below the floor (in seconds) is never an overload, e.g. the jitter of the renames on a local disk
+        self.latencyFloor = latencyFloor
+        self.decreaseFactor = decreaseFactor
+        self.errorDecreaseFactor = errorDecreaseFactor
+        self.condition = threading.Condition()
+        self.inFlightCount = 0
+        self.completedCount = 0
+        self.errorCount = 0
+        self.totalLatency = 0.0
+        self.minimumLatency = None
+        # do not decrease again before the operations started at the old limit are completed
+        self.completedCountBeforeNextDecrease = 0
+
+    def acquire(self):
+        '''Wait for a free slot, return the start time to be given back to release()'''
+        with self.condition:
+            while self.inFlightCount >= int(self.concurrency):
+                self.condition.wait()
+            self.inFlightCount = self.inFlightCount + 1
+        return time.monotonic()
+
+    def release(self, startTime, isError = False):
+        '''Give the slot back, and adapt the limit to the latency of the operation.
+        isError is only for the congestion errors of the destination, see isCongestionError.'''
+        latency = time.monotonic() - startTime
+        with self.condition:
+            self.inFlightCount = self.inFlightCount - 1
+            self.completedCount = self.completedCount + 1
+            self.totalLatency = self.totalLatency + latency
+            if self.completedCountBeforeNextDecrease > 0:
+                self.completedCountBeforeNextDecrease = self.completedCountBeforeNextDecrease - 1
+            if isError:
+                self.errorCount = self.errorCount + 1
+                self.decrease(self.errorDecreaseFactor)
+            else:
+                if self.minimumLatency is None or latency < self.minimumLatency:
+                    self.minimumLatency = latency
+                if latency > self.latencyFloor and latency > self.minimumLatency * self.latencyTolerance:
+                    self.decrease(self.decreaseFactor)
+                else:
+                    # additive increase, about one more slot after a full round of operations
+                    self.concurrency = min(self.maximumConcurrency, self.concurrency + 1.0 / self.concurrency)
+            self.condition.notify_all()
+
+    def decrease(self, factor):
+        '''Decrease the limit multiplicatively, at most once per round of operations. The caller holds the condition.'''
+        if self.completedCountBeforeNextDecrease > 0:
+            return
+        self.concurrency = max(self.minimumConcurrency, self.concurrency * factor)
+        self.completedCountBeforeNextDecrease = self.inFlightCount + 1
+
+    def getStats(self):
+        '''Get the current concurrency and the counters, as a dict'''
+        with self.condition:
+            return {"concurrency": int(self.concurrency),
+                    "inFlight": self.inFlightCount,
+                    "completed": self.completedCount,
+                    "errors": self.errorCount,
+                    "averageLatency": self.totalLatency / self.completedCount if self.completedCount > 0 else 0.0}
+
+def formatConcurrencyStats(stats):
+    '''Format the stats of AdaptiveConcurrencyController for the output'''
+    return ("Completed " + str(stats["completed"]) + " operations, " + str(stats["errors"]) + " errors, "
+            + "average latency " + format(stats["averageLatency"] * 1000, ".1f") + " ms, current concurrency " + str(stats["concurrency"]) + ".")
+
+class DeviceScheduler:
+    '''Limit the concurrent operations on the destination device, shared by the workers of all source devices.
+    The limit adapts to the destination (see AdaptiveConcurrencyController), up to destinationConcurrency.'''
+    def __init__(self, perDeviceConcurrency = 2, destinationConcurrency = 4, concurrencyController = None):
+        self.perDeviceConcurrency = perDeviceConcurrency
+        self.concurrencyController = AdaptiveConcurrencyController(destinationConcurrency) if concurrencyController is None else concurrencyController
+
+    def groupFolderListByDevice(self, folderPathList):
+        '''Group the folders by the device they are on. Return a dict of device ID -> folder path list.'''
+        folderPathListDict = {}
+        for folderPath in folderPathList:
+            folderPathListDict.setdefault(os.stat(folderPath).st_dev, []).append(folderPath)
+        return folderPathListDict
+
+    def runDeviceWorkers(self, taskListDict, planFunction, executeFunction):
+        '''Run perDeviceConcurrency workers for each device. taskListDict is a dict of device ID -> list of (folderPath, filename).
+        The workers call planFunction(folderPath, filename) on their own device,
+        and executeFunction(plannedResult) while holding the destination device slot.
+        executeFunction returns the error of the failed operation, None if there is no error.'''
+        threadList = []
+        for deviceID, taskList in taskListDict.items():
+            # the files of the same device are shared by its workers
+            taskQueue = queue.Queue()
+            for task in taskList:
+                taskQueue.put(task)
+            for i in range(self.perDeviceConcurrency):
+                thread = threading.Thread(target = self.deviceWorker, args = (taskQueue, planFunction, executeFunction),
+                                          name = "device-" + str(deviceID) + "-" + str(i), daemon = True)
+                thread.start()
+                threadList.append(thread)
+        for thread in threadList:
+            thread.join()
+
+    def deviceWorker(self, taskQueue, planFunction, executeFunction):
+        '''Take the files of one device from the queue, until the queue is empty'''
+        while True:
+            try:
+                folderPath, filename = taskQueue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                plannedResult = planFunction(folderPath, filename)
+                if plannedResult is not None:
+                    startTime = self.concurrencyController.acquire()
+                    error = None
+                    try:
+                        error = executeFunction(plannedResult)
+                    except Exception as e:
+                        error = e
+                        raise
+                    finally:
+                        # only the timeouts and the I/O errors slow the destination down
+                        self.concurrencyController.release(startTime, isError = isCongestionError(error))
+            except Exception as e:
+                logger.warning("Error: " + str(e))
+
+def renameMediaFilesInFolderList(sourceFolderList, destinationFolder, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False,
+                                 layout = DestinationLayout.Flat, perDeviceConcurrency = 2, destinationConcurrency = 4, sniffResultDict = None,
+                                 concurrencyController = None, progressReporter = None, timeOffsetTable = None, destinationBackend = None,
+                                 listenerList = None):
+    '''Rename the media files in all the source folders into the destination folder, in parallel per source device.
+    sniffResultDict is the sniffed content of the files (see deleteTrashFiles), used to tell videos from images.
+    The progress of the plan and execute stages is counted by progressReporter, if it is given.
+    The time shift of timeOffsetTable is folded into the plan, if it is given.
+    The files are moved through destinationBackend (see DestinationBackend), if it is given.
+    The listeners of listenerList are notified of every file renamed or moved, see fileOperationListenerList.
+    Return the stats of the concurrency controller of the destination device.'''
+    # the fds of the source folders are looked up by the folder of each operation, which has no trailing separator
+    sourceFolderList = list(dict.fromkeys(os.path.normpath(sourceFolder) for sourceFolder in sourceFolderList))
+    isLocalDestination = destinationBackend is None or destinationBackend.isLocal
+    if isLocalDestination:
+        os.makedirs(destinationFolder, exist_ok = True)
+    # one destination filename index for all the source folders
+    destinationFolderIndex = DestinationFolderIndex(destinationFolder, destinationBackend)
+    scheduler = DeviceScheduler(perDeviceConcurrency, destinationConcurrency, concurrencyController)
+    if progressReporter is not None:
+        progressReporter.setConcurrencyController(scheduler.concurrencyController)
+    # list every source folder once, pair the sidecar files, and group the primary files by device
+    sidecarIndex = SidecarIndex()
+    taskListDict = {}
+    for deviceID, folderPathList in scheduler.groupFolderListByDevice(sourceFolderList).items():
+        taskList = taskListDict.setdefault(deviceID, [])
+        for sourceFolder in folderPathList:
+            for filename in sidecarIndex.addFolder(sourceFolder):
+                taskList.append((sourceFolder, filename))
+        if progressReporter is not None:
+            progressReporter.addTotal("plan", len(taskList))
+
+    with contextlib.ExitStack() as stack:
+        # open every folder once, the fds are shared by the workers. The remote destinations have no folder to open.
+        destinationFolderFd = stack.enter_context(openFolderFd(destinationFolder)) if isLocalDestination else None
+        sourceFolderFdDict = {}
+        for sourceFolder in sourceFolderList:
+            sourceFolderFdDict[sourceFolder] = stack.enter_context(openFolderFd(sourceFolder))
+
+        def planFunction(sourceFolder, filename):
+            filePath = os.path.join(sourceFolder, filename)
+            planStartTime = time.monotonic()
+            renameOperation = planRenameMediaFile(filePath, destinationFolder, overrideCameraID, defaultCameraID,
+                                                  isUseModifiedTime, destinationFolderFd, layout, destinationFolderIndex, 
+                                                  sidecarIndex.getSidecarFilenameList(sourceFolder, filename), getFileType(filePath, sniffResultDict),
+                                                  timeOffsetTable)
+            if progressReporter is not None:
+                progressReporter.addPlanned(None if renameOperation is None else renameOperation.newFilename, time.monotonic() - planStartTime)
+            return renameOperation
+
+        def executeFunction(renameOperation):
+            sourceFolderFd = sourceFolderFdDict[renameOperation.sourceFolderPath]
+            executeStartTime = time.monotonic()
+            fileSize = 0
+            if progressReporter is not None:
+                fileSize = getFileSizeInFolder(renameOperation.sourceFolderPath, renameOperation.filename, sourceFolderFd)
+            isDone = executeRenameOperation(renameOperation, sourceFolderFd, destinationFolderFd, destinationFolderIndex, destinationBackend,
+                                            listenerList)
+            if progressReporter is not None:
+                progressReporter.reportExecuted(isDone, fileSize, time.monotonic() - executeStartTime)
+            return renameOperation.error
+
+        scheduler.runDeviceWorkers(taskListDict, planFunction, executeFunction)
+    return scheduler.concurrencyController.getStats()
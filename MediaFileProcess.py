@@ -1,102 +1,244 @@
-import os
-import os.path
-import argparse
-
-from FileUtility import *
-
-# create an ArgumentParser object
-parser = argparse.ArgumentParser()
-# add an argument for the camera ID (-i or --camera-id)
-parser.add_argument('-oci','--override-camera-id', help='Set the camera ID brutally, ignoring other information. \n This is a dangerous action, be sure you know what you are doing.', default = None)
-
-parser.add_argument('-s','--source-folder', help='Set the source folder. If not set, the default is current folder', default = None)
-parser.add_argument('-d','--destination-folder', help='Set the destination folder. If not set, it will be the same with the source folder', default = None)
-
-parser.add_argument('-r','-recover','--recover-original-filenames', action='store_true', help='Reset the file names to original', default=False)
-
-parser.add_argument('-l','-list','--list-files', action='store_true', help='List the files in the folder', default=False)
-
-parser.add_argument('-p', '--process', action='store_true', help='Process the files in the folder', default=False)
-
-parser.add_argument('-m', '--merge-airdrop-sub-folders', action='store_true', help='Merge the sub-folders generated by Airdrop in the folder', default=False)
-parser.add_argument('-mf', '--merge-sub-folders', action='store_true', help="Merge all the sub-folders in the folder", default=False)
-
-#parser.add_argument('-tso', '--time-stamp-offset', help='Set the time stamp offset in seconds', default = None)
-parser.add_argument('-sts', '--source-time-stamp', help='Set the source time stamp format', default = None)
-parser.add_argument('-dts', '--destination-time-stamp', help='Set the destination time stamp format', default = None)
-
-parser.add_argument('-umt', '--use-modified-time', action='store_true', help='Use the modified time of the file instead of creation time for new file name', default=False)
-# The format of the time stamp is:
-# YYYY-MM-DD_HH-MM-SS-TT.*
-
-
-# parse the command-line arguments
-args = parser.parse_args()
-overrideCameraID = args.override_camera_id
-
-sourceFolder = None
-destinationFolder = None
-
-sourceTimeStamp = None
-destinationTimeStamp = None
-timeStampOffset = None
-
-isUseModifiedTime = False
-
-if args.source_folder is None:
-    sourceFolder = os.getcwd()
-else:
-    sourceFolder = args.source_folder
-
-if args.destination_folder is None:
-    destinationFolder = sourceFolder
-else:
-    destinationFolder = args.destination_folder
-
-if args.source_time_stamp is not None:
-    sourceTimeStamp = args.source_time_stamp
-if args.destination_time_stamp is not None:
-    destinationTimeStamp = args.destination_time_stamp
-
-if args.use_modified_time:
-    isUseModifiedTime = True
-   
-print("Processing started...")
-print("Source folder: " + sourceFolder)
-print("Destination folder: " + destinationFolder)
-
-if args.list_files:
-    checkFilesInFolder(sourceFolder, printDetailedList=True)
-
-if args.merge_airdrop_sub_folders:
-    if isThereAirdropSubFolder(sourceFolder):
-        print("Start merging the Airdrop subfolders in the folder: " + sourceFolder)
-        mergeAirdropSubFolders(sourceFolder, destinationFolder)
-        sourceFolder = destinationFolder
-if args.merge_sub_folders:
-    if isThereSubFolder(sourceFolder):
-        print("Start merging all the subfolders in the folder: " + sourceFolder)
-        mergeSubFolders(sourceFolder, destinationFolder)
-        sourceFolder = destinationFolder
-
-if destinationTimeStamp is not None and sourceTimeStamp is not None:
-    # modify the creation time of the files in the folder to deal with the wrong time stamp caused by the camera setting.
-    print("Start changing the creation time of the files in the folder: " + sourceFolder)
-    print("From: " + sourceTimeStamp + " to: " + destinationTimeStamp)
-    print("The rest files will use the same time stamp offset.")
-    changeFileCreationTimeInFolder(sourceFolder, sourceTimeStamp, destinationTimeStamp)
-
-if args.recover_original_filenames:
-    # reset the file name to the original name in the folder
-    print("Start recover the video filename to the original name from: \n"
-          + sourceFolder + "\n to: \n" + destinationFolder)
-    restoreOriginalFilenamesInFolder(sourceFolder, destinationFolder)
-elif args.process:
-    deleteTrashFiles(sourceFolder)
-    # rename the video file name to the formatted name in the folder
-    print("Start renaming the video filename to the formatted name from: \n" 
-          + sourceFolder + "\n to: \n" + destinationFolder)
-    renameMediaFilesInFolder(sourceFolder, 
-                             destinationFolder, 
-                             overrideCameraID, 
-                             defaultCameraID="Cid")    
\ No newline at end of file
+# The command line of the media file processing, a thin wrapper over the API in MediaPipeline.py.
+
+import os
+import os.path
+import sys
+import argparse
+import logging
+
+from FileUtility import *
+from MediaPipeline import MediaProcessConfig, processFolders, restoreFolder
+from MediaLibraryIndex import MediaLibraryIndex
+from IngestScheduler import formatConcurrencyStats
+from ChecksumManifest import ChecksumManifest, checksumAlgorithmList, verifyManifest
+from ProgressReporter import ProgressReporter, PrometheusTextfileWriter
+from DestinationBackend import isS3Url, createS3DestinationBackend
+
+def createArgumentParser():
+    '''Create the ArgumentParser of the command line'''
+    # create an ArgumentParser object
+    parser = argparse.ArgumentParser()
+    # add an argument for the camera ID (-i or --camera-id)
+    parser.add_argument('-oci','--override-camera-id', help='Set the camera ID brutally, ignoring other information. \n This is a dangerous action, be sure you know what you are doing.', default = None)
+
+    parser.add_argument('-s','--source-folder', action='extend', nargs='+', help='Set the source folder(s). If not set, the default is current folder. \n Several source folders (e.g. card readers) can be processed in one run', default = None)
+    parser.add_argument('-d','--destination-folder', help='Set the destination folder. If not set, it will be the same with the source folder. \n It can be an S3 bucket as s3://bucket/prefix (needs boto3), the files are uploaded there by -p', default = None)
+    parser.add_argument('-s3e', '--s3-endpoint-url', help='Set the endpoint URL of an S3 compatible server (e.g. http://localhost:9000 for MinIO). If not set, AWS S3 is used', default = None)
+    parser.add_argument('-dc', '--device-concurrency', type=int, help='Set the number of parallel operations per source device. The default is 2', default = 2)
+    parser.add_argument('-dstc', '--destination-concurrency', type=int, help='Set the number of parallel operations on the destination device. The default (and the maximum of the adaptive concurrency) is 4', default = 4)
+
+    parser.add_argument('-fc', '--fixed-concurrency', action='store_true', help='Use the fixed number of parallel operations instead of adapting it to the latency of the destination', default=False)
+
+    parser.add_argument('-pml', '--plan-memory-limit', type=int, help='Plan the files in the captured order with the memory limit in MB, spilling to temporary files. \n The unique IDs do not depend on the directory listing order then', default = None)
+
+    parser.add_argument('-r','-recover','--recover-original-filenames', action='store_true', help='Reset the file names to original', default=False)
+
+    parser.add_argument('-rcp', '--restore-conflict-policy', choices=[policy.value for policy in RestoreConflictPolicy], 
+                        help='Set what to do when several files are restored to the same original filename. The default is suffix', default=RestoreConflictPolicy.Suffix.value)
+
+    parser.add_argument('-l','-list','--list-files', action='store_true', help='List the files in the folder', default=False)
+
+    parser.add_argument('-p', '--process', action='store_true', help='Process the files in the folder', default=False)
+
+    parser.add_argument('-m', '--merge-airdrop-sub-folders', action='store_true', help='Merge the sub-folders generated by Airdrop in the folder', default=False)
+    parser.add_argument('-mf', '--merge-sub-folders', action='store_true', help="Merge all the sub-folders in the folder", default=False)
+
+    #parser.add_argument('-tso', '--time-stamp-offset', help='Set the time stamp offset in seconds', default = None)
+    parser.add_argument('-sts', '--source-time-stamp', help='Set the source time stamp format', default = None)
+    parser.add_argument('-dts', '--destination-time-stamp', help='Set the destination time stamp format', default = None)
+    parser.add_argument('-tsc', '--time-shift-camera', nargs=3, action='append', metavar=('CAMERA_ID', 'SOURCE_TIME_STAMP', 'DESTINATION_TIME_STAMP'),
+                        help='Shift the time of the files of the camera ID only, can be repeated for several cameras', default = None)
+    parser.add_argument('-tst', '--time-shift-filename-type', nargs=3, action='append', metavar=('FILENAME_TYPE', 'SOURCE_TIME_STAMP', 'DESTINATION_TIME_STAMP'),
+                        help='Shift the time of the files of the filename type only (e.g. GxPPSSSS for GoPro), can be repeated', default = None)
+    parser.add_argument('-fts', '--fold-time-shift', action='store_true', help='Shift the times while renaming the files (-p), so the new names use the shifted times without a second pass', default=False)
+
+    parser.add_argument('-umt', '--use-modified-time', action='store_true', help='Use the modified time of the file instead of creation time for new file name', default=False)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print the details of every file', default=False)
+    parser.add_argument('-ks', '--keep-sidecar-files', action='store_true', help='Keep the .THM and .LRV files, and rename them together with their video files', default=False)
+    parser.add_argument('-lo', '--layout', choices=[layout.value for layout in DestinationLayout], 
+                        help='Set the sub folder layout in the destination folder, based on the captured date. The default is flat', default=DestinationLayout.Flat.value)
+
+    parser.add_argument('-li', '--library-index', help='Set the SQLite library index file. Every rename, restore and delete updates it', default = None)
+    parser.add_argument('-ali', '--add-to-library-index', action='store_true', help='Add the formatted files in the source folder(s) and their sub folders to the library index', default=False)
+    parser.add_argument('-q', '--query', action='store_true', help='Query the library index instead of processing the files, see --query-camera-id, --query-from and --query-to', default=False)
+    parser.add_argument('-qci', '--query-camera-id', help='Only query the files of the camera ID', default = None)
+    parser.add_argument('-qf', '--query-from', help='Only query the files captured from the date (and time), YYYYMMDD or YYYYMMDD_HHMMSSTT', default = None)
+    parser.add_argument('-qt', '--query-to', help='Only query the files captured until the date (and time), YYYYMMDD or YYYYMMDD_HHMMSSTT', default = None)
+
+    parser.add_argument('-cm', '--checksum-manifest', help='Write the checksum, size, new name and original name of every renamed or moved file to the manifest file. \n The new names are relative to the folder of the manifest', default = None)
+    parser.add_argument('-ca', '--checksum-algorithm', choices=checksumAlgorithmList, help='Set the checksum algorithm of the manifest. The default is blake2b', default='blake2b')
+    parser.add_argument('-vm', '--verify', action='store_true', help='Verify the files against the checksum manifest (-cm) instead of processing the files', default=False)
+    parser.add_argument('-pg', '--progress', action='store_true', help='Report the files done/total, the bytes per second and the ETA of every stage, every few seconds', default=False)
+    parser.add_argument('-pt', '--prometheus-textfile', help='Write the metrics of the run to the Prometheus textfile collector file (e.g. /var/lib/node_exporter/ingest.prom)', default = None)
+    parser.add_argument('-pti', '--prometheus-interval', type=float, help='Set the interval in seconds between the writes of the Prometheus metrics. The default is 15', default = 15.0)
+    # The format of the time stamp is:
+    # YYYY-MM-DD_HH-MM-SS-TT.*
+    return parser
+
+def createTimeOffsetTable(args):
+    '''Create the TimeOffsetTable from the time stamps of the command line arguments, None if no time is shifted.
+    Raise ValueError if a time stamp or a filename type is not correct.'''
+    if args.source_time_stamp is None and args.destination_time_stamp is None and not args.time_shift_camera and not args.time_shift_filename_type:
+        return None
+
+    def getOffset(sourceTimeStamp, destinationTimeStamp):
+        offset = getTimeOffsetInNanoseconds(sourceTimeStamp, destinationTimeStamp)
+        if offset is None:
+            raise ValueError("The time stamps " + sourceTimeStamp + " and " + destinationTimeStamp + " are not in the format of YYYY-MM-DD_HH-MM-SS-TT.")
+        return offset
+
+    timeOffsetTable = TimeOffsetTable()
+    if args.source_time_stamp is not None and args.destination_time_stamp is not None:
+        timeOffsetTable.defaultOffset = getOffset(args.source_time_stamp, args.destination_time_stamp)
+    for cameraID, sourceTimeStamp, destinationTimeStamp in args.time_shift_camera or []:
+        timeOffsetTable.setCameraIDOffset(cameraID, getOffset(sourceTimeStamp, destinationTimeStamp))
+    for filenameTypeName, sourceTimeStamp, destinationTimeStamp in args.time_shift_filename_type or []:
+        if filenameTypeName not in FilenameType.__members__:
+            raise ValueError("The filename type " + filenameTypeName + " is unknown, it is one of " + ", ".join(FilenameType.__members__) + ".")
+        timeOffsetTable.setFilenameTypeOffset(FilenameType[filenameTypeName], getOffset(sourceTimeStamp, destinationTimeStamp))
+    return timeOffsetTable
+
+def createConfig(args, timeOffsetTable = None):
+    '''Create the MediaProcessConfig from the command line arguments.
+    The time shift is folded into the plan if it is asked with --fold-time-shift.'''
+    return MediaProcessConfig(destinationFolder = args.destination_folder,
+                              overrideCameraID = args.override_camera_id,
+                              defaultCameraID = "Cid",
+                              isUseModifiedTime = args.use_modified_time,
+                              layout = DestinationLayout(args.layout),
+                              isKeepSidecarFiles = args.keep_sidecar_files,
+                              restoreConflictPolicy = RestoreConflictPolicy(args.restore_conflict_policy),
+                              perDeviceConcurrency = args.device_concurrency,
+                              destinationConcurrency = args.destination_concurrency,
+                              isAdaptiveConcurrency = not args.fixed_concurrency,
+                              planMemoryLimit = None if args.plan_memory_limit is None else args.plan_memory_limit * 1024 * 1024,
+                              progressReporter = ProgressReporter(5.0 if args.progress else None) 
+                                                 if args.progress or args.prometheus_textfile is not None else None,
+                              timeOffsetTable = timeOffsetTable if args.fold_time_shift and args.process else None)
+
+def main(argv = None):
+    # parse the command-line arguments
+    args = createArgumentParser().parse_args(argv)
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO, format = "%(message)s")
+    try:
+        timeOffsetTable = createTimeOffsetTable(args)
+    except ValueError as e:
+        print(e)
+        return 1
+    config = createConfig(args, timeOffsetTable)
+    if isS3Url(args.destination_folder):
+        if args.merge_airdrop_sub_folders or args.merge_sub_folders or args.recover_original_filenames:
+            print("The sub folders can not be merged and the original filenames can not be recovered into an S3 destination.")
+            return 1
+        try:
+            # the uploads in flight are at most the parallel operations of the pipeline, or of the destination device
+            config.destinationBackend = createS3DestinationBackend(args.destination_folder, args.s3_endpoint_url,
+                                                                   maxWorkers = max(config.maxWorkers, config.destinationConcurrency))
+        except (ValueError, RuntimeError) as e:
+            print(e)
+            return 1
+    # the listeners of the file operations of this run
+    config.fileOperationListenerList = []
+
+    if args.source_folder is None:
+        sourceFolderList = [os.getcwd()]
+    else:
+        # remove the duplicated source folders (a/ and a are the same), keep the order
+        sourceFolderList = list(dict.fromkeys(os.path.normpath(sourceFolder) for sourceFolder in args.source_folder))
+
+    libraryIndex = None
+    if args.library_index is not None:
+        libraryIndex = MediaLibraryIndex(args.library_index)
+        # keep the library index up to date with every file operation
+        config.fileOperationListenerList.append(libraryIndex)
+
+    if args.query:
+        if libraryIndex is None:
+            print("The library index is not set, use -li to set it.")
+            return 1
+        # answer the query from the index only, without touching the files
+        for path, capturedAt, cameraID, uniqueID, originalFilename, fileSize, fileType in libraryIndex.query(args.query_camera_id, args.query_from, args.query_to):
+            print(capturedAt + " " + cameraID + " " + fileType + " " + str(fileSize) + " " + path)
+        libraryIndex.close()
+        return 0
+
+    if args.verify:
+        if args.checksum_manifest is None:
+            print("The checksum manifest is not set, use -cm to set it.")
+            return 1
+        fileCount, failedList = verifyManifest(args.checksum_manifest, config.maxWorkers)
+        print(str(fileCount) + " files are verified, " + str(len(failedList)) + " of them do not match the manifest.")
+        return 0 if not failedList else 1
+
+    checksumManifest = None
+    if args.checksum_manifest is not None:
+        checksumManifest = ChecksumManifest(args.checksum_manifest, args.checksum_algorithm, config.maxWorkers)
+        # hash every file renamed or moved
+        config.fileOperationListenerList.append(checksumManifest)
+
+    prometheusTextfileWriter = None
+    if args.prometheus_textfile is not None:
+        prometheusTextfileWriter = PrometheusTextfileWriter(config.progressReporter, args.prometheus_textfile, args.prometheus_interval)
+
+    # if the destination folder is not set, every source folder is its own destination folder
+    print("Processing started...")
+    print("Source folder: " + ", ".join(sourceFolderList))
+    print("Destination folder: " + (", ".join(sourceFolderList) if config.destinationFolder is None else config.destinationFolder))
+
+    for i, sourceFolder in enumerate(sourceFolderList):
+        if args.list_files:
+            checkFilesInFolder(sourceFolder, printDetailedList=True)
+
+        if args.merge_airdrop_sub_folders:
+            if isThereAirdropSubFolder(sourceFolder):
+                print("Start merging the Airdrop subfolders in the folder: " + sourceFolder)
+                mergeAirdropSubFolders(sourceFolder, config.getDestinationFolder(sourceFolder), config.maxWorkers, config.fileOperationListenerList)
+                sourceFolder = sourceFolderList[i] = config.getDestinationFolder(sourceFolder)
+        if args.merge_sub_folders:
+            if isThereSubFolder(sourceFolder):
+                print("Start merging all the subfolders in the folder: " + sourceFolder)
+                mergeSubFolders(sourceFolder, config.getDestinationFolder(sourceFolder), config.maxWorkers, config.fileOperationListenerList)
+                sourceFolder = sourceFolderList[i] = config.getDestinationFolder(sourceFolder)
+
+        if timeOffsetTable is not None and config.timeOffsetTable is None:
+            # modify the creation time of the files in the folder to deal with the wrong time stamp caused by the camera setting.
+            print("Start changing the creation time of the files in the folder: " + sourceFolder)
+            if args.source_time_stamp is not None and args.destination_time_stamp is not None:
+                print("From: " + args.source_time_stamp + " to: " + args.destination_time_stamp)
+                print("The rest files will use the same time stamp offset.")
+            shiftedCount = shiftFileTimesInFolder(sourceFolder, timeOffsetTable, config.overrideCameraID, config.defaultCameraID, config.maxWorkers)
+            print(str(shiftedCount) + " files are shifted.")
+
+        if args.recover_original_filenames:
+            # reset the file name to the original name in the folder
+            print("Start recover the video filename to the original name from: \n"
+                  + sourceFolder + "\n to: \n" + config.getDestinationFolder(sourceFolder))
+            restoreFolder(sourceFolder, config)
+
+    # the merged folders might be the same now
+    sourceFolderList = list(dict.fromkeys(os.path.normpath(sourceFolder) for sourceFolder in sourceFolderList))
+
+    if args.process and not args.recover_original_filenames:
+        # rename the video file name to the formatted name in the folder
+        print("Start renaming the video filename to the formatted name from: \n" 
+              + ", ".join(sourceFolderList) + "\n to: \n" + (", ".join(sourceFolderList) if config.destinationFolder is None else config.destinationFolder))
+        print(formatConcurrencyStats(processFolders(sourceFolderList, config)))
+
+    if args.add_to_library_index and libraryIndex is not None:
+        for sourceFolder in sourceFolderList:
+            print("Adding the files in the folder " + sourceFolder + " to the library index.")
+            print(str(libraryIndex.addFolder(sourceFolder)) + " files are added.")
+
+    if config.progressReporter is not None:
+        config.progressReporter.report(isForced = True)
+    if prometheusTextfileWriter is not None:
+        prometheusTextfileWriter.close()
+    if libraryIndex is not None:
+        libraryIndex.close()
+    if checksumManifest is not None:
+        checksumManifest.close()
+        print(str(checksumManifest.writtenCount) + " files are written to the checksum manifest.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
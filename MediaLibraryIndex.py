@@ -0,0 +1,152 @@
+# In this file, the renamed media files are kept in a SQLite index,
+# so "all the clips from camera X between two dates" can be answered without listing the folders.
+
+# The index is kept up to date as a listener of the file operations in FileUtility:
+# every rename, restore, move and delete updates it.
+# The captured date and time, camera ID, unique ID and original filename are parsed from the FormattedV4 name.
+
+import os
+import os.path
+import re
+import sqlite3
+import threading
+import logging
+
+from FileUtility import *
+
+logger = logging.getLogger(__name__)
+
+class MediaLibraryIndex:
+    '''The SQLite index of the renamed media files'''
+    def __init__(self, databasePath, commitInterval = 1000):
+        # the file operations might come from the worker threads
+        self.connection = sqlite3.connect(databasePath, check_same_thread = False)
+        self.lock = threading.Lock()
+        self.commitInterval = commitInterval
+        self.uncommittedCount = 0
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS media_file (
+                path TEXT PRIMARY KEY,
+                captured_at TEXT NOT NULL,  -- YYYYMMDD_HHMMSSTT
+                camera_id TEXT NOT NULL,
+                unique_id INTEGER NOT NULL,
+                original_name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                file_type TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS media_file_captured_at ON media_file (captured_at);
+            CREATE INDEX IF NOT EXISTS media_file_camera_id_captured_at ON media_file (camera_id, captured_at);
+        ''')
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def __enter__(self):
+        addFileOperationListener(self)
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        removeFileOperationListener(self)
+        self.close()
+
+    def commitIfNeeded(self):
+        '''Commit the changes in batches, the caller holds the lock'''
+        self.uncommittedCount = self.uncommittedCount + 1
+        if self.uncommittedCount >= self.commitInterval:
+            self.connection.commit()
+            self.uncommittedCount = 0
+
+    def addFile(self, filePath, fileSize = None):
+        '''Add (or update) the file in the index, if it has a FormattedV4 name. Return True if it is added.'''
+        record = getMediaFileRecord(filePath, fileSize)
+        if record is None:
+            return False
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO media_file VALUES (?, ?, ?, ?, ?, ?, ?)', record)
+            self.commitIfNeeded()
+        return True
+
+    def removeFile(self, filePath):
+        with self.lock:
+            self.connection.execute('DELETE FROM media_file WHERE path = ?', (os.path.abspath(filePath),))
+            self.commitIfNeeded()
+
+    def addFolder(self, folderPath, isRecursive = True):
+        '''Add all the formatted files in the folder (and its sub folders) to the index. Return the number of files added.'''
+        addedCount = 0
+        with os.scandir(folderPath) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if isRecursive:
+                        addedCount = addedCount + self.addFolder(entry.path, isRecursive)
+                elif entry.is_file() and self.addFile(entry.path, entry.stat().st_size):
+                    addedCount = addedCount + 1
+        return addedCount
+
+    def onFileRenamed(self, oldFilePath, newFilePath):
+        self.removeFile(oldFilePath)
+        if "://" in newFilePath:
+            # the objects uploaded to a remote destination (see DestinationBackend) are not in the local library
+            logger.debug("The uploaded object " + newFilePath + " is not added to the library index.")
+            return
+        # the restored files are not formatted any more, so they are only removed
+        self.addFile(newFilePath)
+
+    def onFileDeleted(self, filePath):
+        self.removeFile(filePath)
+
+    def query(self, cameraID = None, capturedFrom = None, capturedTo = None):
+        '''Get the records of the files, optionally filtered by the camera ID and the captured date (and time) range.
+        capturedFrom and capturedTo are in the format of YYYYMMDD or YYYYMMDD_HHMMSSTT, both inclusive.
+        Return a list of (path, captured_at, camera_id, unique_id, original_name, size, file_type), in the captured order.'''
+        conditionList = []
+        parameterList = []
+        if cameraID is not None:
+            conditionList.append('camera_id = ?')
+            parameterList.append(cameraID)
+        if capturedFrom is not None:
+            conditionList.append('captured_at >= ?')
+            parameterList.append(padCapturedAt(capturedFrom, "0"))
+        if capturedTo is not None:
+            conditionList.append('captured_at <= ?')
+            parameterList.append(padCapturedAt(capturedTo, "9"))
+        sql = 'SELECT * FROM media_file'
+        if conditionList:
+            sql = sql + ' WHERE ' + ' AND '.join(conditionList)
+        sql = sql + ' ORDER BY captured_at, camera_id, unique_id'
+        with self.lock:
+            return self.connection.execute(sql, parameterList).fetchall()
+
+def padCapturedAt(capturedAt, paddingDigit):
+    '''Pad YYYYMMDD or a partial YYYYMMDD_HHMMSSTT to the full length, so it can be compared with the captured_at column'''
+    if len(capturedAt) == 8:
+        capturedAt = capturedAt + "_"
+    return capturedAt + paddingDigit * (17 - len(capturedAt))
+
+def getMediaFileRecord(filePath, fileSize = None):
+    '''Get the index record of the file from its FormattedV4 name. Return None if the file is not formatted as FormattedV4.'''
+    filename = os.path.basename(filePath)
+    filenameWithoutExtension, fileExtension = os.path.splitext(filename)
+    match = re.match(FilenamePattern[FilenameType.FormattedV4], filenameWithoutExtension)
+    if match is None:
+        return None
+    capturedAt = "".join(match.group(1, 2, 3)) + "_" + "".join(match.group(4, 5, 6, 7))
+    cameraID = match.group(8)
+    uniqueID = 1 if match.group(9) is None else int(match.group(9)[1:])
+    originalFilename = getSidecarOriginalFilename(match.group(10) + fileExtension)
+    if fileSize is None:
+        try:
+            fileSize = os.stat(filePath).st_size
+        except OSError:
+            return None
+    if isVideoFile(filename):
+        fileType = FileType.Video
+    elif isImageFile(filename):
+        fileType = FileType.Image
+    elif isSidecarFile(filename):
+        fileType = FileType.KnownButUseless
+    else:
+        fileType = FileType.Unknown
+    return (os.path.abspath(filePath), capturedAt, cameraID, uniqueID, originalFilename, fileSize, fileType.name)
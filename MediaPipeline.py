@@ -0,0 +1,273 @@
+# In this file, there is the importable Python API of the media file processing.
+# MediaFileProcess.py is a thin command line wrapper over it.
+
+# The processing is split into three streaming stages, each of them is a generator:
+#   scan(sourceFolder, config)        -> MediaFileRecord, the media files with their sidecar files and sniffed content
+#   plan(mediaFileRecords, config)    -> RenameOperation, the new names in the destination folder
+#                                        (or planInCapturedOrder(sourceFolderList, config) for huge folders, see ExternalMemoryPlanner)
+#   execute(renameOperations, config) -> ExecutionRecord, the result of each rename
+# e.g. for record in execute(plan(scan(folder, config), config), config): ...
+# A long-lived worker can process any number of folders with one MediaProcessConfig, without starting a new process.
+
+import os
+import os.path
+import time
+import collections
+import contextlib
+import concurrent.futures
+import logging
+
+from FileUtility import *
+from IngestScheduler import renameMediaFilesInFolderList, AdaptiveConcurrencyController, isCongestionError
+from ExternalMemoryPlanner import ExternalMemoryPlanner
+from ProgressReporter import getCountedSkipFunction
+
+logger = logging.getLogger(__name__)
+
+class MediaProcessConfig:
+    '''The settings of the media file processing, shared by all the stages'''
+    def __init__(self, destinationFolder = None, overrideCameraID = None, defaultCameraID = "Cid", isUseModifiedTime = False,
+                 layout = DestinationLayout.Flat, isDeleteTrashFiles = True, isKeepSidecarFiles = False, isSniffContent = True,
+                 restoreConflictPolicy = RestoreConflictPolicy.Suffix, perDeviceConcurrency = 2, destinationConcurrency = 4, maxWorkers = 8,
+                 isAdaptiveConcurrency = True, planMemoryLimit = None, progressReporter = None, timeOffsetTable = None,
+                 destinationBackend = None, fileOperationListenerList = None):
+        # if the destination folder is None, the files are renamed in their source folder
+        self.destinationFolder = destinationFolder
+        # the camera ID set brutally, ignoring other information
+        self.overrideCameraID = overrideCameraID
+        self.defaultCameraID = defaultCameraID
+        self.isUseModifiedTime = isUseModifiedTime
+        self.layout = layout
+        # delete the empty and corrupted media files, the invisible files, and the sidecar files unless they are kept
+        self.isDeleteTrashFiles = isDeleteTrashFiles
+        self.isKeepSidecarFiles = isKeepSidecarFiles
+        # sniff the file content to tell videos from images, instead of trusting the extension
+        self.isSniffContent = isSniffContent
+        self.restoreConflictPolicy = restoreConflictPolicy
+        self.perDeviceConcurrency = perDeviceConcurrency
+        self.destinationConcurrency = destinationConcurrency
+        # the number of parallel operations within one folder
+        self.maxWorkers = maxWorkers
+        # adapt the number of operations in flight (up to maxWorkers / destinationConcurrency) to the latency of the destination
+        self.isAdaptiveConcurrency = isAdaptiveConcurrency
+        # if it is set (in bytes), the files are planned in the captured order by ExternalMemoryPlanner, with the memory limit
+        self.planMemoryLimit = planMemoryLimit
+        # the ProgressReporter of the stages, None to count nothing
+        self.progressReporter = progressReporter
+        # the time shift folded into the plan (see TimeOffsetTable), None to keep the times
+        self.timeOffsetTable = timeOffsetTable
+        # the backend of the destination folder (see DestinationBackend), e.g. an S3 bucket, None for the local folder
+        self.destinationBackend = destinationBackend
+        # the listeners of the file operations of this job, e.g. the library index and the checksum manifest.
+        # If it is None, the global listeners of FileUtility.addFileOperationListener are notified.
+        self.fileOperationListenerList = fileOperationListenerList
+
+    def getDestinationFolder(self, sourceFolder):
+        return sourceFolder if self.destinationFolder is None else self.destinationFolder
+
+    def getDestinationBackend(self, destinationFolder):
+        '''Get the backend of the destination folder, None if it is a local folder'''
+        return self.destinationBackend if destinationFolder == self.destinationFolder else None
+
+    def isLocalDestination(self, destinationFolder):
+        destinationBackend = self.getDestinationBackend(destinationFolder)
+        return destinationBackend is None or destinationBackend.isLocal
+
+class MediaFileRecord:
+    '''A media file found by scan()'''
+    def __init__(self, folderPath, filename, fileType = FileType.Unknown, fileContentStatus = FileContentStatus.Unknown, sidecarFilenameList = None):
+        self.folderPath = folderPath
+        self.filename = filename
+        self.fileType = fileType
+        self.fileContentStatus = fileContentStatus
+        self.sidecarFilenameList = [] if sidecarFilenameList is None else sidecarFilenameList
+
+    def getFilePath(self):
+        return os.path.join(self.folderPath, self.filename)
+
+class ExecutionRecord:
+    '''The result of a RenameOperation run by execute()'''
+    def __init__(self, renameOperation, isDone, error = None):
+        self.renameOperation = renameOperation
+        self.isDone = isDone
+        self.error = error
+
+def scan(sourceFolder, config, sniffResultDict = None, isDeleteTrashFiles = False):
+    '''Yield a MediaFileRecord for each file in the folder, except the sidecar files which come with their primary files.
+    sniffResultDict is the already sniffed content (see deleteTrashFiles), otherwise the content is sniffed if config.isSniffContent.
+    With isDeleteTrashFiles, the trash files are deleted in the same pass over the folder (see getTrashFunction),
+    and the empty and corrupted media files once they are sniffed.'''
+    progressReporter = config.progressReporter
+    sidecarIndex = SidecarIndex()
+    # the files already formatted in place are skipped while listing, and not sniffed
+    skipFunction = getFormattedInPlaceSkipFunction(sourceFolder, config.destinationFolder, config.overrideCameraID,
+                                                   config.isUseModifiedTime, config.layout, sniffResultDict, config.timeOffsetTable)
+    skipFunction = getCountedSkipFunction(skipFunction, progressReporter)
+    trashFunction = None
+    if isDeleteTrashFiles:
+        trashFunction = getTrashFunction(sourceFolder, config.isKeepSidecarFiles, listenerList = config.fileOperationListenerList)
+    scanStartTime = time.monotonic()
+    # the folder is listed only once, for the trash files, the sidecar files and the files to sniff
+    filenameList = sidecarIndex.addFolder(sourceFolder, skipFunction, trashFunction)
+    if sniffResultDict is None and (config.isSniffContent or isDeleteTrashFiles):
+        sniffResultDict = sniffFilesInFolder(sourceFolder, [filename for filename in filenameList if isVideoOrImageFile(filename)],
+                                             config.maxWorkers)
+        if isDeleteTrashFiles:
+            deletedFilePathSet = deleteCorruptedSniffedFiles(sourceFolder, sniffResultDict, listenerList = config.fileOperationListenerList)
+            filenameList = [filename for filename in filenameList if os.path.join(sourceFolder, filename) not in deletedFilePathSet]
+    if progressReporter is not None:
+        # the folder is listed and sniffed at once, the latency is shared by its files
+        scanLatency = (time.monotonic() - scanStartTime) / max(len(filenameList), 1)
+        progressReporter.addTotal("scan", len(filenameList))
+        progressReporter.addTotal("plan", len(filenameList))
+    for filename in filenameList:
+        filePath = os.path.join(sourceFolder, filename)
+        fileContentStatus = FileContentStatus.Unknown if sniffResultDict is None \
+            else sniffResultDict.get(filePath, (FileType.Unknown, FileContentStatus.Unknown))[1]
+        if progressReporter is not None:
+            progressReporter.addDone("scan", latency = scanLatency)
+        yield MediaFileRecord(sourceFolder, filename, getFileType(filePath, sniffResultDict), fileContentStatus,
+                              sidecarIndex.getSidecarFilenameList(sourceFolder, filename))
+
+def plan(mediaFileRecords, config, destinationFolderIndex = None):
+    '''Yield a RenameOperation for each media file record which needs to be renamed or moved.
+    The name collisions are checked in destinationFolderIndex, which is created for the destination folder if not given.'''
+    destinationFolderIndexDict = {}
+    for record in mediaFileRecords:
+        destinationFolder = config.getDestinationFolder(record.folderPath)
+        index = destinationFolderIndex
+        if index is None:
+            index = destinationFolderIndexDict.get(destinationFolder)
+            if index is None:
+                index = destinationFolderIndexDict[destinationFolder] = createDestinationFolderIndex(destinationFolder, config)
+        planStartTime = time.monotonic()
+        renameOperation = planRenameMediaFile(record.getFilePath(), destinationFolder, config.overrideCameraID, config.defaultCameraID,
+                                              config.isUseModifiedTime, None, config.layout, index, record.sidecarFilenameList, record.fileType,
+                                              config.timeOffsetTable)
+        if config.progressReporter is not None:
+            config.progressReporter.addPlanned(None if renameOperation is None else renameOperation.newFilename, time.monotonic() - planStartTime)
+        if renameOperation is not None:
+            yield renameOperation
+
+def planInCapturedOrder(sourceFolderList, config, sniffResultDict = None, isDeleteTrashFiles = False):
+    '''Yield the RenameOperations of all the media files in the source folders, in the captured order,
+    so the unique IDs do not depend on the order of the directory listing. The records are spilled to the disk
+    above config.planMemoryLimit (see ExternalMemoryPlanner).
+    The files are sniffed, and the trash files are deleted with isDeleteTrashFiles, while each folder is listed, like scan().'''
+    with ExternalMemoryPlanner(config.destinationFolder, config.overrideCameraID, config.defaultCameraID, config.isUseModifiedTime,
+                               config.layout, config.planMemoryLimit, progressReporter = config.progressReporter,
+                               timeOffsetTable = config.timeOffsetTable, isSniffContent = config.isSniffContent,
+                               isDeleteTrashFiles = isDeleteTrashFiles, isKeepSidecarFiles = config.isKeepSidecarFiles,
+                               maxWorkers = config.maxWorkers, listenerList = config.fileOperationListenerList) as planner:
+        for sourceFolder in sourceFolderList:
+            planner.addFolder(sourceFolder, sniffResultDict)
+        yield from planner.getRenameOperations(config.destinationBackend)
+
+def execute(renameOperations, config, destinationFolderIndex = None, concurrencyController = None):
+    '''Run the rename operations in parallel, and yield an ExecutionRecord for each of them, in the order of the operations.
+    Every folder is opened only once. The number of operations in flight is adapted to the latency of the destination
+    by concurrencyController, up to config.maxWorkers, so the plan can be streamed.
+    Only the timeouts and the I/O errors slow it down (see isCongestionError), not the name collisions or the permission errors.'''
+    if concurrencyController is None:
+        concurrencyController = createConcurrencyController(config)
+    if config.progressReporter is not None:
+        config.progressReporter.setConcurrencyController(concurrencyController)
+    with contextlib.ExitStack() as stack:
+        folderFdDict = {}
+        def getFolderFd(folderPath):
+            # the remote destinations have no folder to open
+            if not config.isLocalDestination(folderPath):
+                return None
+            if folderPath not in folderFdDict:
+                folderFdDict[folderPath] = stack.enter_context(openFolderFd(folderPath))
+            return folderFdDict[folderPath]
+
+        def run(renameOperation, sourceFolderFd, destinationFolderFd, startTime):
+            executionRecord = None
+            fileSize = 0
+            try:
+                if config.progressReporter is not None:
+                    fileSize = getFileSizeInFolder(renameOperation.sourceFolderPath, renameOperation.filename, sourceFolderFd)
+                isDone = executeRenameOperation(renameOperation, sourceFolderFd, destinationFolderFd, destinationFolderIndex,
+                                                config.getDestinationBackend(renameOperation.destinationFolderPath), config.fileOperationListenerList)
+                executionRecord = ExecutionRecord(renameOperation, isDone, renameOperation.error)
+            except Exception as e:
+                logger.warning("Error: " + str(e))
+                executionRecord = ExecutionRecord(renameOperation, False, e)
+            concurrencyController.release(startTime, isError = isCongestionError(executionRecord.error))
+            if config.progressReporter is not None:
+                config.progressReporter.reportExecuted(executionRecord.isDone, fileSize, time.monotonic() - startTime)
+            return executionRecord
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = config.maxWorkers) as executor:
+            futureQueue = collections.deque()
+            for renameOperation in renameOperations:
+                sourceFolderFd = getFolderFd(renameOperation.sourceFolderPath)
+                destinationFolderFd = getFolderFd(renameOperation.destinationFolderPath)
+                # wait for a free slot, the limit grows and shrinks with the observed latency
+                startTime = concurrencyController.acquire()
+                futureQueue.append(executor.submit(run, renameOperation, sourceFolderFd, destinationFolderFd, startTime))
+                while len(futureQueue) >= config.maxWorkers * 4:
+                    yield futureQueue.popleft().result()
+            while futureQueue:
+                yield futureQueue.popleft().result()
+
+def createDestinationFolderIndex(destinationFolder, config):
+    '''Create the index of the destination folder, listed through its backend if any. The local destination folder is created.'''
+    if config.isLocalDestination(destinationFolder):
+        os.makedirs(destinationFolder, exist_ok = True)
+    return DestinationFolderIndex(destinationFolder, config.getDestinationBackend(destinationFolder))
+
+def createConcurrencyController(config):
+    '''Create the controller of the operations in flight. Without adaptive concurrency, the limit is fixed to config.maxWorkers.'''
+    if config.isAdaptiveConcurrency:
+        return AdaptiveConcurrencyController(config.maxWorkers)
+    return AdaptiveConcurrencyController(config.maxWorkers, config.maxWorkers)
+
+def processFolder(sourceFolder, config, concurrencyController = None):
+    '''Delete the trash files (if configured) and rename the media files of one folder. Yield the ExecutionRecords.
+    The files already formatted in place are skipped before they are sniffed, so a re-run only lists the folder.'''
+    destinationFolderIndex = createDestinationFolderIndex(config.getDestinationFolder(sourceFolder), config)
+    yield from execute(plan(scan(sourceFolder, config, isDeleteTrashFiles = config.isDeleteTrashFiles), config, destinationFolderIndex), config,
+                       destinationFolderIndex, concurrencyController)
+
+def processFolders(sourceFolderList, config):
+    '''Rename the media files of several folders. With a destination folder, all the source folders go into it in parallel,
+    scheduled by their devices (see IngestScheduler). Otherwise, every folder is renamed in place.
+    With config.planMemoryLimit, all the files are planned in the captured order (see planInCapturedOrder) instead.
+    Return the stats of the concurrency controller, including the current concurrency.'''
+    if config.planMemoryLimit is not None:
+        return processFoldersInCapturedOrder(sourceFolderList, config)
+    if config.destinationFolder is None or len(sourceFolderList) == 1:
+        concurrencyController = createConcurrencyController(config)
+        for sourceFolder in sourceFolderList:
+            for executionRecord in processFolder(sourceFolder, config, concurrencyController):
+                pass
+        return concurrencyController.getStats()
+    sniffResultDict = {}
+    for sourceFolder in sourceFolderList:
+        if config.isDeleteTrashFiles:
+            sniffResultDict.update(deleteTrashFiles(sourceFolder, config.isKeepSidecarFiles, config.fileOperationListenerList))
+    concurrencyController = None
+    if not config.isAdaptiveConcurrency:
+        concurrencyController = AdaptiveConcurrencyController(config.destinationConcurrency, config.destinationConcurrency)
+    return renameMediaFilesInFolderList(sourceFolderList, config.destinationFolder, config.overrideCameraID, config.defaultCameraID,
+                                        config.isUseModifiedTime, config.layout, config.perDeviceConcurrency, config.destinationConcurrency,
+                                        sniffResultDict if config.isDeleteTrashFiles else None, concurrencyController, config.progressReporter,
+                                        config.timeOffsetTable, config.destinationBackend, config.fileOperationListenerList)
+
+def processFoldersInCapturedOrder(sourceFolderList, config):
+    '''Rename the media files of the folders, planned in the captured order, and streamed to execute().
+    Return the stats of the concurrency controller.'''
+    concurrencyController = createConcurrencyController(config)
+    # the planner checks the names in the destination folders itself, without listing them into the memory,
+    # and the files are sniffed and the trash files deleted by batches, so nothing is held for all the files
+    for executionRecord in execute(planInCapturedOrder(sourceFolderList, config, isDeleteTrashFiles = config.isDeleteTrashFiles), config,
+                                   concurrencyController = concurrencyController):
+        pass
+    return concurrencyController.getStats()
+
+def restoreFolder(sourceFolder, config):
+    '''Restore the original filenames of the files in the folder. Return the list of (filename, reason) which can not be restored.'''
+    return restoreOriginalFilenamesInFolder(sourceFolder, config.getDestinationFolder(sourceFolder), config.restoreConflictPolicy, config.maxWorkers,
+                                            config.fileOperationListenerList)
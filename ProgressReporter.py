@@ -0,0 +1,223 @@
+# In this file, the progress of the long ingest runs is reported, per stage of the pipeline (scan, plan, execute):
+# the files done and expected, the bytes per second and the ETA, at most once per report interval.
+
+# The same counters can be exported as Prometheus textfile-collector metrics (see PrometheusTextfileWriter),
+# rewritten at intervals by a background thread, so the node exporter can alert on the stalled ingests.
+
+import os
+import os.path
+import time
+import threading
+import datetime
+import logging
+
+from FileUtility import hasUniqueIDSuffix
+
+logger = logging.getLogger(__name__)
+
+# the upper bounds of the latency histogram buckets, in seconds
+defaultLatencyBucketList = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0]
+# the counters of the results of the files
+counterNameList = ["renamed", "skipped", "collisions", "errors"]
+
+class StageProgress:
+    '''The progress of one stage of the pipeline'''
+    def __init__(self, name, latencyBucketList):
+        self.name = name
+        self.totalCount = 0
+        self.doneCount = 0
+        self.byteCount = 0
+        self.startTime = time.monotonic()
+        self.latencyBucketList = latencyBucketList
+        # the number of the latencies in each bucket, the last one is +Inf
+        self.latencyBucketCountList = [0] * (len(latencyBucketList) + 1)
+        self.latencySum = 0.0
+        self.latencyCount = 0
+
+    def addLatency(self, latency):
+        for i, upperBound in enumerate(self.latencyBucketList):
+            if latency <= upperBound:
+                self.latencyBucketCountList[i] = self.latencyBucketCountList[i] + 1
+                break
+        else:
+            self.latencyBucketCountList[-1] = self.latencyBucketCountList[-1] + 1
+        self.latencySum = self.latencySum + latency
+        self.latencyCount = self.latencyCount + 1
+
+    def format(self):
+        '''Format the progress as files done/total, bytes per second and ETA'''
+        elapsedTime = max(time.monotonic() - self.startTime, 1e-6)
+        outputString = self.name + ": " + str(self.doneCount) + "/" + str(self.totalCount) + " files"
+        if self.byteCount > 0:
+            outputString += ", " + format(self.byteCount / elapsedTime / (1024 * 1024), ".1f") + " MB/s"
+        if 0 < self.doneCount < self.totalCount:
+            remainingTime = (self.totalCount - self.doneCount) * elapsedTime / self.doneCount
+            outputString += ", ETA " + str(datetime.timedelta(seconds = int(remainingTime)))
+        return outputString
+
+class ProgressReporter:
+    '''Count the progress of the pipeline stages and the results of the files, and report them at most once per reportInterval.
+    If reportInterval is None, nothing is reported, the counters are only exported (see PrometheusTextfileWriter).'''
+    def __init__(self, reportInterval = 5.0, latencyBucketList = defaultLatencyBucketList):
+        self.reportInterval = reportInterval
+        self.latencyBucketList = latencyBucketList
+        self.lock = threading.Lock()
+        # the stages in the order they are started
+        self.stageDict = {}
+        self.counterDict = dict.fromkeys(counterNameList, 0)
+        self.lastReportTime = time.monotonic()
+        self.lastUpdateTime = time.time()
+        # the AdaptiveConcurrencyController of the execute stage, its current concurrency is reported with the counters
+        self.concurrencyController = None
+
+    def setConcurrencyController(self, concurrencyController):
+        '''Report the current concurrency of the controller, see AdaptiveConcurrencyController'''
+        self.concurrencyController = concurrencyController
+
+    def getConcurrency(self):
+        '''Get the current concurrency, None if there is no controller'''
+        concurrencyController = self.concurrencyController
+        return None if concurrencyController is None else concurrencyController.getStats()["concurrency"]
+
+    def getStage(self, stage):
+        '''Get the progress of the stage, the caller holds the lock'''
+        stageProgress = self.stageDict.get(stage)
+        if stageProgress is None:
+            stageProgress = self.stageDict[stage] = StageProgress(stage, self.latencyBucketList)
+        return stageProgress
+
+    def addTotal(self, stage, fileCount = 1):
+        '''Add the files expected in the stage'''
+        with self.lock:
+            stageProgress = self.getStage(stage)
+            stageProgress.totalCount = stageProgress.totalCount + fileCount
+
+    def addDone(self, stage, byteCount = 0, latency = None):
+        '''Count a file done in the stage, with its size and the latency of its operation'''
+        with self.lock:
+            stageProgress = self.getStage(stage)
+            stageProgress.doneCount = stageProgress.doneCount + 1
+            stageProgress.byteCount = stageProgress.byteCount + byteCount
+            if latency is not None:
+                stageProgress.addLatency(latency)
+            self.lastUpdateTime = time.time()
+        self.report()
+
+    def addPlanned(self, newFilename, latency = None):
+        '''Count a file planned with its new name, None if it is skipped. The unique ID _NN in the new name is a name collision.'''
+        self.addDone("plan", latency = latency)
+        if newFilename is None:
+            self.increment("skipped")
+            return
+        self.addTotal("execute")
+        if hasUniqueIDSuffix(newFilename):
+            self.increment("collisions")
+
+    def reportExecuted(self, isDone, byteCount = 0, latency = None):
+        '''Count a file renamed or moved, or failed'''
+        self.increment("renamed" if isDone else "errors")
+        self.addDone("execute", byteCount if isDone else 0, latency)
+
+    def increment(self, counterName, count = 1):
+        '''Increase the counter of the results, see counterNameList'''
+        with self.lock:
+            self.counterDict[counterName] = self.counterDict[counterName] + count
+            self.lastUpdateTime = time.time()
+
+    def report(self, isForced = False):
+        '''Log the progress of every stage, if the report interval is passed since the last report'''
+        if self.reportInterval is None:
+            return
+        concurrency = self.getConcurrency()
+        with self.lock:
+            now = time.monotonic()
+            if not isForced and now - self.lastReportTime < self.reportInterval:
+                return
+            self.lastReportTime = now
+            outputString = "; ".join(stageProgress.format() for stageProgress in self.stageDict.values())
+            counterString = ", ".join(name + " " + str(count) for name, count in self.counterDict.items())
+            if concurrency is not None:
+                counterString += ", concurrency " + str(concurrency)
+        logger.info(outputString + " (" + counterString + ")")
+
+    def getPrometheusText(self):
+        '''Get the counters and the stage latency histograms in the Prometheus text format'''
+        lineList = []
+        concurrency = self.getConcurrency()
+        with self.lock:
+            for name in counterNameList:
+                lineList.append("# TYPE media_ingest_" + name + "_total counter")
+                lineList.append("media_ingest_" + name + "_total " + str(self.counterDict[name]))
+            lineList.append("# TYPE media_ingest_stage_files_total counter")
+            for stageProgress in self.stageDict.values():
+                lineList.append('media_ingest_stage_files_total{stage="' + stageProgress.name + '"} ' + str(stageProgress.doneCount))
+            lineList.append("# TYPE media_ingest_stage_files_expected gauge")
+            for stageProgress in self.stageDict.values():
+                lineList.append('media_ingest_stage_files_expected{stage="' + stageProgress.name + '"} ' + str(stageProgress.totalCount))
+            lineList.append("# TYPE media_ingest_stage_bytes_total counter")
+            for stageProgress in self.stageDict.values():
+                lineList.append('media_ingest_stage_bytes_total{stage="' + stageProgress.name + '"} ' + str(stageProgress.byteCount))
+            lineList.append("# TYPE media_ingest_stage_latency_seconds histogram")
+            for stageProgress in self.stageDict.values():
+                label = 'stage="' + stageProgress.name + '"'
+                cumulativeCount = 0
+                for upperBound, bucketCount in zip(self.latencyBucketList + ["+Inf"], stageProgress.latencyBucketCountList):
+                    cumulativeCount = cumulativeCount + bucketCount
+                    lineList.append("media_ingest_stage_latency_seconds_bucket{" + label + ',le="' + str(upperBound) + '"} ' + str(cumulativeCount))
+                lineList.append("media_ingest_stage_latency_seconds_sum{" + label + "} " + repr(stageProgress.latencySum))
+                lineList.append("media_ingest_stage_latency_seconds_count{" + label + "} " + str(stageProgress.latencyCount))
+            if concurrency is not None:
+                # the operations allowed in flight, shrinking when the destination is overloaded
+                lineList.append("# TYPE media_ingest_concurrency gauge")
+                lineList.append("media_ingest_concurrency " + str(concurrency))
+            # the time of the last progress, an ingest is stalled if it is not moving
+            lineList.append("# TYPE media_ingest_last_progress_timestamp_seconds gauge")
+            lineList.append("media_ingest_last_progress_timestamp_seconds " + format(self.lastUpdateTime, ".3f"))
+        return "\n".join(lineList) + "\n"
+
+def getCountedSkipFunction(skipFunction, progressReporter):
+    '''Count the files skipped by the skip function of the listing (see getFormattedInPlaceSkipFunction)'''
+    if skipFunction is None or progressReporter is None:
+        return skipFunction
+    def countedSkipFunction(entry):
+        if skipFunction(entry):
+            progressReporter.increment("skipped")
+            return True
+        return False
+    return countedSkipFunction
+
+class PrometheusTextfileWriter:
+    '''Write the metrics of the ProgressReporter to a .prom file of the node exporter textfile collector, every interval seconds.
+    The file is replaced atomically, so the collector never reads a half written file.'''
+    def __init__(self, progressReporter, textfilePath, interval = 15.0):
+        self.progressReporter = progressReporter
+        self.textfilePath = textfilePath
+        self.interval = interval
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = "prometheus-textfile", daemon = True)
+        self.thread.start()
+
+    def write(self):
+        temporaryPath = self.textfilePath + ".tmp"
+        with open(temporaryPath, "w", encoding = "utf-8") as textfile:
+            textfile.write(self.progressReporter.getPrometheusText())
+        os.replace(temporaryPath, self.textfilePath)
+
+    def run(self):
+        while not self.stopEvent.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                logger.warning("Error: can not write the metrics to " + self.textfilePath + ": " + str(e))
+
+    def close(self):
+        '''Stop the background thread, and write the final metrics'''
+        self.stopEvent.set()
+        self.thread.join()
+        self.write()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()